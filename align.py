@@ -11,11 +11,22 @@ therefore do not need to be tokenized beforehand, and no knowledge of the
 tokenization is needed to make use of the alignment result.
 '''
 import argparse
+import importlib
+import os
 import sys
-from spacy.lang.en import English
-from spacy.lang.ja import Japanese
-from transformers import pipeline
-from simplify import simplify
+from collections.abc import Sequence
+from threading import Lock
+from typing import Any, Callable, Iterable, Iterator
+import numpy as np
+from cache import LRUCache
+from qa import DEFAULT_BATCH_SIZE
+from scored import ScoredAlignment, SYMMETRIC_MODES, as_pairs, symmetrize
+from simplify import simplify, SIMPLIFY_MODES
+import binary
+import models
+import profiling
+import qa
+import simplify_exact
 
 # BERT-based model pretrained on the Kyoto Free Translation Task (KFTT) dataset.
 MODEL = 'qiyuw/WSPAlign-ft-kftt'
@@ -32,23 +43,148 @@ DEFAULT_THRESHOLD = 0.1
 # These tokenizers are used to mark words (often morphemes) in the 'from' text
 # for alignment; the ML pipeline gets fed untokenized strings which get broken
 # down differently and mapped to vocab ids by the model's BertTokenizer.
+# Importing spaCy (which imports torch) and loading a language's dictionaries
+# takes a few seconds, so each is only done the first time it's used; see
+# get_tokenizer.
 TOKENIZERS = {
-  'en': English().tokenizer,
-  'ja': Japanese().tokenizer
+  'en': ('spacy.lang.en', 'English'),
+  'ja': ('spacy.lang.ja', 'Japanese'),
 }
 
-def get_token_ranges(language: str, text: str) -> list[tuple[int, int]]:
+_languages: dict[str, Any] = {}
+
+# SudachiPy (used for Japanese) raises an error if a tokenizer is used by more
+# than one thread at a time, e.g. by concurrent requests to visualize.py.
+TOKENIZER_LOCKS = { language: Lock() for language in TOKENIZERS }
+
+# Number of texts passed to each tokenizer process at a time by
+# get_token_ranges_many.
+TOKENIZE_BATCH_SIZE = 256
+
+class TokenRanges(Sequence[tuple[int, int]]):
+  '''
+  The (start, end) of each token, in order, as returned by `get_token_ranges`.
+
+  The ranges are stored only as an (n, 2) int32 array, which takes 8 bytes per
+  token rather than a tuple of ints, and is used to look up many spans or token
+  pairs at once. Indexing and iterating give (start, end) tuples as before.
+  Since tokens don't overlap, both the starts and the ends are sorted, so the
+  tokens intersecting a range of characters are found by binary search rather
+  than by checking every token.
+
+  The array is read-only, as the same ranges are shared through `token_cache`.
+  '''
+  __slots__ = ('array',)
+
+  def __init__(self, ranges: Iterable[tuple[int, int]] | np.ndarray = ()):
+    self.array = as_pairs(ranges if isinstance(ranges, np.ndarray) else list(ranges))
+    self.array.flags.writeable = False
+
+  def __len__(self) -> int:
+    return len(self.array)
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return TokenRanges(self.array[index])
+    (start, end) = self.array[index].tolist()
+    return (start, end)
+
+  def __iter__(self) -> Iterator[tuple[int, int]]:
+    return map(tuple, self.array.tolist())
+
+  def __eq__(self, other: object) -> bool:
+    if isinstance(other, (TokenRanges, list)):
+      return list(self) == list(other)
+    return NotImplemented
+
+  __hash__ = None
+
+  def __repr__(self) -> str:
+    return f'TokenRanges({list(self)!r})'
+
+  @property
+  def nbytes(self) -> int:
+    return self.array.nbytes
+
+  def find(self, start: int, end: int) -> list[int]:
+    '''Returns the indexes of the tokens that intersect the given range.'''
+    first = int(np.searchsorted(self.array[:, 1], start, side='right'))
+    last = int(np.searchsorted(self.array[:, 0], end, side='left'))
+    return list(range(first, last))
+
+  def find_many(self, starts: np.ndarray, ends: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    '''
+    Finds the tokens intersecting each of the (`starts[i]`, `ends[i]`) ranges.
+    Returns (i, token) pairs as two arrays, ordered by i and then by token.
+    '''
+    first = np.searchsorted(self.array[:, 1], starts, side='right')
+    last = np.searchsorted(self.array[:, 0], ends, side='left')
+    counts = np.maximum(last - first, 0)
+    spans = np.repeat(np.arange(len(counts)), counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    return spans, np.repeat(first, counts) + offsets
+
+def as_token_ranges(token_ranges: list[tuple[int, int]]) -> TokenRanges:
+  return token_ranges if isinstance(token_ranges, TokenRanges) else TokenRanges(token_ranges)
+
+# Token ranges of recently tokenized texts, keyed by language and text, since
+# the same sentence is often aligned more than once (against several
+# translations, or in both directions). The size of each entry includes its
+# text as well as the token ranges.
+token_cache = LRUCache(
+  int(os.environ.get('TOKEN_CACHE_MB', 16)) * 2**20,
+  size_of=lambda token_ranges: token_ranges.nbytes)
+
+def get_language(language: str) -> Any:
+  '''Returns the blank spaCy pipeline for the language, creating it on first use.'''
+  with TOKENIZER_LOCKS[language]:
+    if language not in _languages:
+      (module, cls) = TOKENIZERS[language]
+      with profiling.stage('load_tokenizer'):
+        _languages[language] = getattr(importlib.import_module(module), cls)()
+    return _languages[language]
+
+def get_tokenizer(language: str) -> Any:
+  '''Returns the spaCy tokenizer for the language, creating it on first use.'''
+  return get_language(language).tokenizer
+
+def get_token_ranges(language: str, text: str) -> TokenRanges:
   '''Tokenizes the text and returns an array of (start, end) for each token.'''
-  tokenizer = TOKENIZERS[language]
-  return [(t.idx, t.idx + len(t)) for t in tokenizer(text)]
+  [result] = get_token_ranges_many(language, [text])
+  return result
+
+def get_token_ranges_many(language: str, texts: list[str], n_process: int = 1) -> list[TokenRanges]:
+  '''
+  Same as `get_token_ranges` for each text. Texts in `token_cache` aren't
+  tokenized again, and the rest are tokenized together with spaCy's `pipe`,
+  spread over `n_process` processes if more than one. Starting the processes
+  takes seconds, so that's only worth it for many thousands of texts.
+  '''
+  results = { text: token_cache.get((language, text)) for text in texts }
+  missing = [text for (text, result) in results.items() if result is None]
+  if not missing:
+    return [results[text] for text in texts]
+
+  with profiling.stage('tokenize'):
+    if n_process > 1:
+      docs = list(get_language(language).pipe(missing, n_process=n_process, batch_size=TOKENIZE_BATCH_SIZE))
+    else:
+      tokenizer = get_tokenizer(language)
+      with TOKENIZER_LOCKS[language]:
+        docs = list(tokenizer.pipe(missing))
+
+    for (text, doc) in zip(missing, docs):
+      offsets = doc.to_array(['IDX', 'LENGTH']).astype(np.int32).reshape(-1, 2)
+      offsets[:, 1] += offsets[:, 0]
+      results[text] = TokenRanges(offsets)
+      token_cache.put((language, text), results[text])
+
+  profiling.count('tokens', sum(len(results[text]) for text in missing))
+  return [results[text] for text in texts]
 
 def find_token_indexes(token_ranges: list[tuple[int, int]], start: int, end: int) -> list[int]:
   '''Finds the token ranges that intersect the given range.'''
-  indexes: list[int] = []
-  for i, (token_start, token_end) in enumerate(token_ranges):
-    if end > token_start and start < token_end:
-      indexes += [i]
-  return indexes
+  return as_token_ranges(token_ranges).find(start, end)
 
 def wrap_token(from_text: str, start: int, end: int, start_marker: str = MARKER, end_marker: str = MARKER) -> str:
   '''Wraps the part of the text to be aligned.'''
@@ -64,23 +200,97 @@ def print_alignment(from_text: str, from_start: int, from_end: int, to_text: str
   if score is not None:
     print(f' \033[1;30m(score = {score:.10f})\033[m', file=sys.stderr, end='\n\n')
 
-def align_forward(
+# Returns the prediction for each (question, context), like qa.predict.
+Predict = Callable[[list[str], list[str]], list[dict | None]]
+
+def predict_many(
+  items: list[tuple[list[tuple[int, int]], str, str]],
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  predict: Predict | None = None,
+  quantized: bool = False) -> list[list[dict | None]]:
+  '''
+  For each (`from_token_ranges`, `from_text`, `to_text`), predicts the part of
+  `to_text` aligned to each token. The questions for all of the items are run
+  through the model together, so batches are filled across sentence boundaries.
+  `predict` replaces running the model directly, e.g. with serving.py, and
+  `quantized` runs the int8 version of the model (see models.py).
+  '''
+  questions: list[str] = []
+  contexts: list[str] = []
+
+  for (from_token_ranges, from_text, to_text) in items:
+    questions += [wrap_token(from_text, from_start, from_end) for (from_start, from_end) in from_token_ranges]
+    contexts += [to_text] * len(from_token_ranges)
+
+  profiling.count('questions', len(questions))
+  if predict is None:
+    predictions = qa.predict(models.get(models.get_kind('wsp', quantized), MODEL), questions, contexts, batch_size)
+  else:
+    predictions = predict(questions, contexts)
+
+  result: list[list[dict | None]] = []
+  offset = 0
+  for (from_token_ranges, _, _) in items:
+    result.append(predictions[offset:offset + len(from_token_ranges)])
+    offset += len(from_token_ranges)
+
+  return result
+
+def iter_predictions(
+  items: list[tuple[list[tuple[int, int]], str, str]],
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  predict: Predict | None = None,
+  quantized: bool = False) -> Iterator[tuple[int, int, dict | None]]:
+  '''
+  Same as `predict_many`, but yields (item, token, prediction) for each
+  question as soon as the batch containing it has been run. The first question
+  is run on its own and each batch after that is twice the size of the last, up
+  to `batch_size`, so the first result arrives quickly without running the rest
+  one at a time.
+  '''
+  questions: list[str] = []
+  contexts: list[str] = []
+  keys: list[tuple[int, int]] = []
+
+  for i, (from_token_ranges, from_text, to_text) in enumerate(items):
+    questions += [wrap_token(from_text, from_start, from_end) for (from_start, from_end) in from_token_ranges]
+    contexts += [to_text] * len(from_token_ranges)
+    keys += [(i, token) for token in range(len(from_token_ranges))]
+
+  profiling.count('questions', len(questions))
+  model = models.get(models.get_kind('wsp', quantized), MODEL) if predict is None and questions else None
+
+  start = 0
+  size = 1
+  while start < len(questions):
+    end = start + size
+    if predict is None:
+      predictions = qa.predict(model, questions[start:end], contexts[start:end], batch_size)
+    else:
+      predictions = predict(questions[start:end], contexts[start:end])
+
+    for ((i, token), prediction) in zip(keys[start:end], predictions):
+      yield i, token, prediction
+
+    start = end
+    size = min(size * 2, batch_size)
+
+def predictions_to_token_pairs(
   from_token_ranges: list[tuple[int, int]],
   to_token_ranges: list[tuple[int, int]],
   from_text: str,
   to_text: str,
+  predictions: list[dict | None],
   threshold: float = DEFAULT_THRESHOLD) -> list[tuple[int, int]]:
   '''
-  Runs the ML model and returns a list of token pairs mapping indexes of tokens
-  in `from_token_ranges` to those of `to_token_ranges`.
+  Converts the prediction for each token in `from_token_ranges` to token pairs,
+  discarding those below the threshold.
   '''
   result: list[tuple[int, int]] = []
-  pipe = pipeline('question-answering', model=MODEL)
 
-  for from_token, (from_start, from_end) in enumerate(from_token_ranges):
-    prediction = pipe(
-      question=wrap_token(from_text, from_start, from_end),
-      context=to_text)
+  for from_token, ((from_start, from_end), prediction) in enumerate(zip(from_token_ranges, predictions)):
+    if prediction is None:
+      continue
 
     is_above_threshold = prediction['score'] >= threshold
     print_alignment(from_text, from_start, from_end, to_text, prediction['start'], prediction['end'], prediction['score'], is_above_threshold)
@@ -91,16 +301,33 @@ def align_forward(
 
   return result
 
+def align_forward(
+  from_token_ranges: list[tuple[int, int]],
+  to_token_ranges: list[tuple[int, int]],
+  from_text: str,
+  to_text: str,
+  threshold: float = DEFAULT_THRESHOLD,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  quantized: bool = False) -> list[tuple[int, int]]:
+  '''
+  Runs the ML model and returns a list of token pairs mapping indexes of tokens
+  in `from_token_ranges` to those of `to_token_ranges`.
+  '''
+  [predictions] = predict_many([(from_token_ranges, from_text, to_text)], batch_size, quantized=quantized)
+  return predictions_to_token_pairs(from_token_ranges, to_token_ranges, from_text, to_text, predictions, threshold)
+
 def align_reverse(
   from_token_ranges: list[tuple[int, int]],
   to_token_ranges: list[tuple[int, int]],
   from_text: str,
   to_text: str,
-  threshold: float = DEFAULT_THRESHOLD) -> list[tuple[int, int]]:
+  threshold: float = DEFAULT_THRESHOLD,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  quantized: bool = False) -> list[tuple[int, int]]:
   '''
   Calls align_forward with the from and to swapped, then swaps the results back.
   '''
-  result = align_forward(to_token_ranges, from_token_ranges, to_text, from_text, threshold)
+  result = align_forward(to_token_ranges, from_token_ranges, to_text, from_text, threshold, batch_size, quantized)
   return [(to_token, from_token) for (from_token, to_token) in result]
 
 def token_pairs_to_ranges(
@@ -111,15 +338,12 @@ def token_pairs_to_ranges(
   Converts a list of token index pairs (`from_token`, `to_token`) to a flat
   array of `from_start`, `from_end`, `to_start`, and `to_end`.
   '''
-  result: list[int] = []
-
-  for (from_token, to_token) in token_pairs:
-    (from_start, from_end) = from_token_ranges[from_token]
-    (to_start, to_end) = to_token_ranges[to_token]
-    result += [from_start, from_end, to_start, to_end]
-
-  assert len(result) % 4 == 0
-  return result
+  pairs = as_pairs(token_pairs)
+  ranges = np.concatenate([
+    as_token_ranges(from_token_ranges).array[pairs[:, 0]],
+    as_token_ranges(to_token_ranges).array[pairs[:, 1]],
+  ], axis=1)
+  return ranges.reshape(-1).tolist()
 
 def align(
   from_language: str,
@@ -129,7 +353,10 @@ def align(
   threshold: float = DEFAULT_THRESHOLD,
   symmetric: bool = False,
   symmetric_mode: str = 'AND',
-  simplify_result: bool = True) -> list[int]:
+  simplify_result: bool = True,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  simplify_mode: str = 'greedy',
+  quantized: bool = False) -> list[int]:
   '''
   Returns an flat array of `from_start`, `from_end`, `to_start`, and `to_end`,
   repeated for every token in `from_text` that aligns to a part of `to_text`,
@@ -138,17 +365,193 @@ def align(
   from_token_ranges = get_token_ranges(from_language, from_text)
   to_token_ranges = get_token_ranges(to_language, to_text)
 
-  token_pairs = align_forward(from_token_ranges, to_token_ranges, from_text, to_text, threshold)
+  if not symmetric:
+    token_pairs = align_forward(from_token_ranges, to_token_ranges, from_text, to_text, threshold, batch_size, quantized)
+  else:
+    # The questions for both directions are run through the model together
+    # rather than as two separate passes
+    forward, reverse = predict_many([
+      (from_token_ranges, from_text, to_text),
+      (to_token_ranges, to_text, from_text),
+    ], batch_size, quantized=quantized)
+    token_pairs = predictions_to_token_pairs(from_token_ranges, to_token_ranges, from_text, to_text, forward, threshold)
+    reverse_token_pairs = [
+      (from_token, to_token) for (to_token, from_token)
+      in predictions_to_token_pairs(to_token_ranges, from_token_ranges, to_text, from_text, reverse, threshold)
+    ]
+    # The same as for scored alignments, so that both paths give the same result
+    token_pairs = symmetrize(as_pairs(token_pairs), as_pairs(reverse_token_pairs), symmetric_mode)
+
+  result = token_pairs_to_ranges(from_token_ranges, to_token_ranges, token_pairs)
+  return simplify(result, from_text, to_text, simplify_mode) if simplify_result else result
+
+def predictions_to_scored_pairs(
+  to_token_ranges: list[tuple[int, int]],
+  predictions: list[dict | None]) -> tuple[np.ndarray, np.ndarray]:
+  '''
+  Converts the prediction for each "from" token to (from_token, to_token) pairs
+  and their scores, without applying a threshold.
+  '''
+  predictions = [(from_token, p) for (from_token, p) in enumerate(predictions) if p is not None]
+  from_tokens = np.array([from_token for (from_token, _) in predictions], dtype=np.int32)
+  starts = np.array([p['start'] for (_, p) in predictions], dtype=np.int64)
+  ends = np.array([p['end'] for (_, p) in predictions], dtype=np.int64)
+  scores = np.array([p['score'] for (_, p) in predictions], dtype=np.float64)
+
+  spans, to_tokens = as_token_ranges(to_token_ranges).find_many(starts, ends)
+  token_pairs = np.stack([from_tokens[spans], to_tokens.astype(np.int32)], axis=1)
+  return token_pairs, scores[spans]
+
+def align_scored(
+  from_language: str,
+  from_text: str,
+  to_language: str,
+  to_text: str,
+  symmetric: bool = False,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  predict: Predict | None = None,
+  quantized: bool = False) -> ScoredAlignment:
+  '''
+  Runs the model and returns every prediction with its score, to which any
+  threshold and symmetric mode can then be applied (see scored.py).
+  '''
+  [result] = align_many_scored(from_language, to_language, [(from_text, to_text)], symmetric, batch_size, predict, quantized)
+  return result
+
+def align_many_scored(
+  from_language: str,
+  to_language: str,
+  pairs: list[tuple[str, str]],
+  symmetric: bool = False,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  predict: Predict | None = None,
+  quantized: bool = False) -> list[ScoredAlignment]:
+  '''
+  Same as `align_scored`, for a list of (`from_text`, `to_text`) pairs. The
+  questions for every pair, in both directions if `symmetric`, are packed into
+  the same inference batches.
+  '''
+  token_ranges = list(zip(
+    get_token_ranges_many(from_language, [from_text for (from_text, _) in pairs]),
+    get_token_ranges_many(to_language, [to_text for (_, to_text) in pairs])))
+
+  items = [
+    (from_token_ranges, from_text, to_text)
+    for ((from_text, to_text), (from_token_ranges, _)) in zip(pairs, token_ranges)
+  ]
+
+  # The reverse questions are appended to the same workload, so both directions
+  # share inference batches and are tokenized in one call
+  if symmetric:
+    items += [
+      (to_token_ranges, to_text, from_text)
+      for ((from_text, to_text), (_, to_token_ranges)) in zip(pairs, token_ranges)
+    ]
+
+  predictions = predict_many(items, batch_size, predict, quantized)
+  forward = predictions[:len(pairs)]
+  reverse = predictions[len(pairs):]
 
+  return [
+    predictions_to_scored(from_token_ranges, to_token_ranges, forward[i], reverse[i] if symmetric else None)
+    for i, (from_token_ranges, to_token_ranges) in enumerate(token_ranges)
+  ]
+
+def predictions_to_scored(
+  from_token_ranges: TokenRanges,
+  to_token_ranges: TokenRanges,
+  forward: list[dict | None],
+  reverse: list[dict | None] | None = None) -> ScoredAlignment:
+  '''Builds the ScoredAlignment from the predictions in each direction.'''
+  forward_pairs, forward_scores = predictions_to_scored_pairs(to_token_ranges, forward)
+  reverse_pairs, reverse_scores = None, None
+
+  if reverse is not None:
+    reverse_pairs, reverse_scores = predictions_to_scored_pairs(from_token_ranges, reverse)
+    reverse_pairs = np.ascontiguousarray(reverse_pairs[:, ::-1])
+
+  return ScoredAlignment(
+    from_token_ranges.array,
+    to_token_ranges.array,
+    forward_pairs,
+    forward_scores,
+    reverse_pairs,
+    reverse_scores)
+
+def align_scored_stream(
+  from_language: str,
+  from_text: str,
+  to_language: str,
+  to_text: str,
+  symmetric: bool = False,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  predict: Predict | None = None,
+  quantized: bool = False) -> Iterator[dict | ScoredAlignment]:
+  '''
+  Same as `align_scored`, but yields each token's prediction as soon as it is
+  available, followed by the ScoredAlignment. A prediction is a dict of its
+  'direction' ('forward' or 'reverse'), 'score', and 'from_start', 'from_end',
+  'to_start', and 'to_end', which are always in `from_text` and `to_text`
+  respectively, whichever side the token was on.
+  '''
+  from_token_ranges = get_token_ranges(from_language, from_text)
+  to_token_ranges = get_token_ranges(to_language, to_text)
+
+  items = [(from_token_ranges, from_text, to_text)]
   if symmetric:
-    reverse_token_pairs = align_reverse(from_token_ranges, to_token_ranges, from_text, to_text, threshold)
-    if symmetric_mode == 'AND':
-      token_pairs = [x for x in token_pairs if x in reverse_token_pairs]
+    items.append((to_token_ranges, to_text, from_text))
+
+  predictions: list[list[dict | None]] = [[None] * len(token_ranges) for (token_ranges, _, _) in items]
+
+  for (i, token, prediction) in iter_predictions(items, batch_size, predict, quantized):
+    predictions[i][token] = prediction
+    if prediction is None:
+      continue
+
+    (token_start, token_end) = items[i][0][token]
+    if i == 0:
+      yield {
+        'direction': 'forward',
+        'from_start': token_start,
+        'from_end': token_end,
+        'to_start': prediction['start'],
+        'to_end': prediction['end'],
+        'score': prediction['score'],
+      }
     else:
-      token_pairs += reverse_token_pairs
+      yield {
+        'direction': 'reverse',
+        'from_start': prediction['start'],
+        'from_end': prediction['end'],
+        'to_start': token_start,
+        'to_end': token_end,
+        'score': prediction['score'],
+      }
 
-  result = token_pairs_to_ranges(from_token_ranges, to_token_ranges, token_pairs)
-  return simplify(result, from_text, to_text) if simplify_result else result
+  yield predictions_to_scored(from_token_ranges, to_token_ranges, predictions[0], predictions[1] if symmetric else None)
+
+def align_many(
+  from_language: str,
+  to_language: str,
+  pairs: list[tuple[str, str]],
+  threshold: float = DEFAULT_THRESHOLD,
+  symmetric: bool = False,
+  symmetric_mode: str = 'AND',
+  simplify_result: bool = True,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  simplify_mode: str = 'greedy',
+  quantized: bool = False) -> list[list[int]]:
+  '''
+  Same as `align`, for a list of (`from_text`, `to_text`) pairs. The questions
+  for every pair are packed into the same inference batches.
+  '''
+  results: list[list[int]] = []
+
+  for ((from_text, to_text), scored) in zip(pairs, align_many_scored(from_language, to_language, pairs, symmetric, batch_size, quantized=quantized)):
+    result = scored.to_ranges(threshold, symmetric, symmetric_mode)
+    results.append(simplify(result, from_text, to_text, simplify_mode) if simplify_result else result)
+
+  return results
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -158,18 +561,45 @@ if __name__ == '__main__':
   parser.add_argument('--to-text', type=str, required=True)
   parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
   parser.add_argument('--symmetric', action='store_true', default=False)
-  parser.add_argument('--symmetric-mode', type=str, default='AND', choices=['AND', 'OR'])
+  parser.add_argument('--symmetric-mode', type=str, default='AND', choices=SYMMETRIC_MODES)
   parser.add_argument('--no-simplify', action='store_true', default=False)
+  parser.add_argument('--simplify-mode', type=str, default='greedy', choices=SIMPLIFY_MODES)
+  parser.add_argument('--simplify-time-budget', type=float, default=simplify_exact.DEFAULT_TIME_BUDGET, help='Seconds the exact simplify mode searches for each pair before using the best result so far')
+  parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+  parser.add_argument('--quantized', action='store_true', default=False, help='Use dynamic int8 quantization (faster on CPU, see compare_quantized.py)')
+  parser.add_argument('--output-format', type=str, default='text', choices=['text', 'binary'], help='Comma-separated integers, or the format in binary.py')
+  parser.add_argument('--scores', action='store_true', default=False, help='Include the score of each alignment (binary output with --no-simplify only)')
+  parser.add_argument('--profile', action='store_true', default=False, help='Print the time spent in each stage to stderr')
   args = parser.parse_args()
+  profiling.enabled = args.profile
+  simplify_exact.current_time_budget = args.simplify_time_budget
+
+  if args.scores and (args.output_format != 'binary' or not args.no_simplify):
+    parser.error('--scores requires --output-format binary and --no-simplify')
+
+  scores = None
+  if args.scores:
+    scored = align_scored(args.from_language, args.from_text, args.to_language, args.to_text, args.symmetric, args.batch_size, quantized=args.quantized)
+    result = scored.to_ranges(args.threshold, args.symmetric, args.symmetric_mode)
+    scores = scored.scores(args.threshold, args.symmetric, args.symmetric_mode)
+  else:
+    result = align(
+      args.from_language,
+      args.from_text,
+      args.to_language,
+      args.to_text,
+      args.threshold,
+      args.symmetric,
+      args.symmetric_mode,
+      not args.no_simplify,
+      args.batch_size,
+      args.simplify_mode,
+      args.quantized)
+
+  if args.output_format == 'binary':
+    sys.stdout.buffer.write(binary.to_bytes([result], None if scores is None else [scores]))
+  else:
+    print(','.join(str(i) for i in result))
 
-  result = align(
-    args.from_language,
-    args.from_text,
-    args.to_language,
-    args.to_text,
-    args.threshold,
-    args.symmetric,
-    args.symmetric_mode,
-    not args.no_simplify)
-
-  print(','.join(str(i) for i in result))
+  if args.profile:
+    print(profiling.summary(), file=sys.stderr)
@@ -1,13 +1,39 @@
 #!/usr/bin/env python3
 '''
 Runs awesome-align with the same tokenization and output format as align.py
+
+By default the model is loaded into this process once (see models.py) and the
+tokens are passed to awesome-align's extraction code directly. The "subprocess"
+backend instead runs awesome_align.run_align with temp files for every call,
+reloading the model each time.
+
+The in-process backend caches each sentence's embeddings (see get_embeddings),
+bounded by EMBEDDING_CACHE_MB.
 '''
 import argparse
+import itertools
 import os
-from align import get_token_ranges, print_alignment, TOKENIZERS
-from simplify import simplify
+import sys
+import numpy as np
+from align import get_token_ranges_many, print_alignment, token_pairs_to_ranges, TOKENIZERS
+from cache import DirectoryStore, LRUCache
+from simplify import simplify, SIMPLIFY_MODES
 from subprocess import call
 from tempfile import NamedTemporaryFile
+from typing import Callable
+import binary
+import models
+import profiling
+import simplify_exact
+
+DEFAULT_MODEL = 'bert-base-multilingual-cased'
+DEFAULT_BACKEND = 'inprocess'
+
+# Same defaults as awesome_align.run_align.
+ALIGN_LAYER = 8
+EXTRACTION = 'softmax'
+SOFTMAX_THRESHOLD = 0.001
+BATCH_SIZE = 32
 
 def build_tokenized_string(text: str, token_ranges: list[tuple[int, int]]):
   return ' '.join(text[t[0]:t[1]] for t in token_ranges)
@@ -20,61 +46,243 @@ def build_input(from_text: str, from_token_ranges: list[tuple[int, int]], to_tex
 def run_awesome(model: str, input_file_path: str, output_file_path: str):
   if '/' in model and not model.startswith('/'):
     model = '../' + model
-  ret = call([
-    'python3', '-m', 'awesome_align.run_align',
-    '--output_file', os.path.join('..', output_file_path),
-    '--model_name_or_path', model,
-    '--data_file', os.path.join('..', input_file_path),
-    '--cache_dir', '../models/bert'
-  ], cwd='./awesome-align')
+  with profiling.stage('awesome_subprocess'):
+    ret = call([
+      'python3', '-m', 'awesome_align.run_align',
+      '--output_file', os.path.join('..', output_file_path),
+      '--model_name_or_path', model,
+      '--data_file', os.path.join('..', input_file_path),
+      '--cache_dir', '../models/bert'
+    ], cwd='./awesome-align')
   if ret != 0:
     raise ValueError('awesome-align failed')
 
+def tokenize_words(tokenizer, words: list[str]):
+  '''
+  Converts words to model input ids and maps each subword back to the index of
+  its word, as awesome-align's LineByLineTextDataset does for a line of input.
+  '''
+  subwords = [tokenizer.tokenize(word) for word in words]
+  word_ids = [tokenizer.convert_tokens_to_ids(x) for x in subwords]
+  input_ids = tokenizer.prepare_for_model(list(itertools.chain(*word_ids)), return_tensors='pt', max_length=tokenizer.max_len)['input_ids'][0]
+  bpe2word_map = [i for i, word_list in enumerate(subwords) for _ in word_list]
+  return input_ids, bpe2word_map
+
+def tensor_size(tensor) -> int:
+  return tensor.numel() * tensor.element_size()
+
+def save_tensor(tensor, path: str):
+  with open(path, 'wb') as f:
+    np.save(f, tensor.numpy())
+
+def load_tensor(path: str):
+  import torch
+  return torch.from_numpy(np.load(path))
+
+# Contextual embeddings of recently seen sentences, keyed by model kind, model,
+# layer, and tokenized string, so that a sentence aligned against many others
+# only goes through BERT once. Set EMBEDDING_CACHE_DIR to spill evicted entries
+# to disk, where they're limited to EMBEDDING_CACHE_DIR_MB.
+embedding_cache = LRUCache(
+  int(os.environ.get('EMBEDDING_CACHE_MB', 256)) * 2**20,
+  size_of=tensor_size,
+  store=DirectoryStore(
+    os.environ['EMBEDDING_CACHE_DIR'],
+    save_tensor,
+    load_tensor,
+    int(os.environ.get('EMBEDDING_CACHE_DIR_MB', 4096)) * 2**20) if os.environ.get('EMBEDDING_CACHE_DIR') else None)
+
+def get_embeddings(kind: str, model: str, awesome_model, tokenizer, keys: list[str], input_ids: list) -> list:
+  '''
+  Returns the hidden states at ALIGN_LAYER for each tokenized sentence, running
+  only those not already in the embedding cache through the model.
+  '''
+  import torch
+  from torch.nn.utils.rnn import pad_sequence
+
+  embeddings = [embedding_cache.get((kind, model, ALIGN_LAYER, key)) for key in keys]
+
+  # The same sentence may appear more than once in a batch
+  missing: dict[str, int] = {}
+  for i, embedding in enumerate(embeddings):
+    if embedding is None:
+      missing.setdefault(keys[i], i)
+
+  if missing:
+    inputs = pad_sequence([input_ids[i] for i in missing.values()], batch_first=True, padding_value=tokenizer.pad_token_id)
+    with profiling.stage('awesome_embeddings'), torch.no_grad():
+      hidden_states = awesome_model.bert(inputs, align_layer=ALIGN_LAYER, attention_mask=(inputs != tokenizer.pad_token_id))
+
+    computed = {}
+    for row, (key, i) in enumerate(missing.items()):
+      computed[key] = hidden_states[row, :len(input_ids[i])].clone()
+      embedding_cache.put((kind, model, ALIGN_LAYER, key), computed[key])
+
+    embeddings = [computed[key] if embedding is None else embedding for (key, embedding) in zip(keys, embeddings)]
+
+  return embeddings
+
+def extract_alignments(
+    model: str,
+    items: list[tuple[str, list[tuple[int, int]], str, list[tuple[int, int]]]],
+    quantized: bool = False) -> list[list[tuple[int, int]]]:
+  '''
+  Runs awesome-align in-process on each (`from_text`, `from_token_ranges`,
+  `to_text`, `to_token_ranges`) and returns the aligned (from_token, to_token)
+  index pairs for each. This is get_aligned_word, with the BERT forward pass
+  for each sentence going through the embedding cache. `quantized` uses the
+  int8 version of the model (see models.py).
+  '''
+  import torch
+  from torch.nn.utils.rnn import pad_sequence
+
+  kind = models.get_kind('awesome', quantized)
+  awesome_model, tokenizer = models.get(kind, model)
+  results: list[list[tuple[int, int]]] = [[] for _ in items]
+
+  # Pairs with no subwords on either side are skipped by awesome-align and
+  # therefore have no alignments
+  examples = []
+  with profiling.stage('awesome_tokenize'):
+    for i, (from_text, from_token_ranges, to_text, to_token_ranges) in enumerate(items):
+      ids_src, bpe2word_map_src = tokenize_words(tokenizer, [from_text[s:e] for (s, e) in from_token_ranges])
+      ids_tgt, bpe2word_map_tgt = tokenize_words(tokenizer, [to_text[s:e] for (s, e) in to_token_ranges])
+      if len(ids_src) > 2 and len(ids_tgt) > 2:
+        key_src = build_tokenized_string(from_text, from_token_ranges)
+        key_tgt = build_tokenized_string(to_text, to_token_ranges)
+        examples.append((i, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, key_src, key_tgt))
+
+  for batch_start in range(0, len(examples), BATCH_SIZE):
+    indexes, ids_src, ids_tgt, bpe2word_map_src, bpe2word_map_tgt, keys_src, keys_tgt = \
+      zip(*examples[batch_start:batch_start + BATCH_SIZE])
+
+    hidden_states_src = pad_sequence(get_embeddings(kind, model, awesome_model, tokenizer, keys_src, ids_src), batch_first=True)
+    hidden_states_tgt = pad_sequence(get_embeddings(kind, model, awesome_model, tokenizer, keys_tgt, ids_tgt), batch_first=True)
+
+    with profiling.stage('awesome_extract'), torch.no_grad():
+      attention_probs_inter = awesome_model.guide_layer(
+        hidden_states_src,
+        hidden_states_tgt,
+        pad_sequence(ids_src, batch_first=True, padding_value=tokenizer.pad_token_id),
+        pad_sequence(ids_tgt, batch_first=True, padding_value=tokenizer.pad_token_id),
+        extraction=EXTRACTION,
+        softmax_threshold=SOFTMAX_THRESHOLD)
+    attention_probs_inter = attention_probs_inter.float()[:, 0, 1:-1, 1:-1]
+
+    for i, attention, b2w_src, b2w_tgt in zip(indexes, attention_probs_inter, bpe2word_map_src, bpe2word_map_tgt):
+      aligns = set()
+      for src, tgt in torch.nonzero(attention):
+        aligns.add((b2w_src[src], b2w_tgt[tgt]))
+      results[i] = list(aligns)
+
+  return results
+
+def parse_token_mappings(output: str) -> list[tuple[int, int]]:
+  '''Parses a line of awesome-align's output in the "Pharaoh" format.'''
+  return [(int(pair[0]), int(pair[1])) for pair in [pair.split('-') for pair in output.split()]]
+
 def parse_output(
     output: str,
     from_text: str,
     from_token_ranges: list[tuple[int, int]],
     to_text: str,
     to_token_ranges: list[tuple[int, int]],
-    simplify_result: bool = True):
-  result: list[int] = []
-  token_mappings = [(int(pair[0]), int(pair[1])) for pair in [pair.split('-') for pair in output.strip().split(' ')]]
+    simplify_result: bool = True,
+    simplify_mode: str = 'greedy'):
+  token_mappings = parse_token_mappings(output)
+  return token_mappings_to_ranges(token_mappings, from_text, from_token_ranges, to_text, to_token_ranges, simplify_result, simplify_mode)
+
+def token_mappings_to_ranges(
+    token_mappings: list[tuple[int, int]],
+    from_text: str,
+    from_token_ranges: list[tuple[int, int]],
+    to_text: str,
+    to_token_ranges: list[tuple[int, int]],
+    simplify_result: bool = True,
+    simplify_mode: str = 'greedy'):
   token_mappings.sort(key=lambda pair: pair[0])
   for (from_token, to_token) in token_mappings:
     [from_start, from_end] = from_token_ranges[from_token]
     [to_start, to_end] = to_token_ranges[to_token]
-
     print_alignment(from_text, from_start, from_end, to_text, to_start, to_end)
-    result += [from_start, from_end, to_start, to_end]
 
-  assert len(result) % 4 == 0
-  return simplify(result, from_text, to_text) if simplify_result else result
+  result = token_pairs_to_ranges(from_token_ranges, to_token_ranges, token_mappings)
+  return simplify(result, from_text, to_text, simplify_mode) if simplify_result else result
 
 def align(
     from_language: str,
     from_text: str,
     to_language: str,
     to_text: str,
-    model: str = 'bert-base-multilingual-cased',
-    simplify_result: bool = True):
-  with NamedTemporaryFile(mode='+w', prefix='awesome-', suffix='.tmp', dir='.') as input_file, \
-       NamedTemporaryFile(mode='+w', prefix='awesome-', suffix='.tmp', dir='.') as output_file:
+    model: str = DEFAULT_MODEL,
+    simplify_result: bool = True,
+    backend: str = DEFAULT_BACKEND,
+    simplify_mode: str = 'greedy',
+    extract: Callable | None = None,
+    quantized: bool = False):
+  [result] = align_many(from_language, to_language, [(from_text, to_text)], model, simplify_result, backend, simplify_mode, extract, quantized)
+  return result
 
-    from_token_ranges = get_token_ranges(from_language, from_text)
-    to_token_ranges = get_token_ranges(to_language, to_text)
+def align_many(
+    from_language: str,
+    to_language: str,
+    pairs: list[tuple[str, str]],
+    model: str = DEFAULT_MODEL,
+    simplify_result: bool = True,
+    backend: str = DEFAULT_BACKEND,
+    simplify_mode: str = 'greedy',
+    extract: Callable | None = None,
+    quantized: bool = False):
+  '''
+  Same as `align`, for a list of (`from_text`, `to_text`) pairs, which are run
+  through awesome-align together. `extract` replaces the in-process
+  `extract_alignments`, e.g. with serving.py. `quantized` uses the int8 version
+  of the model, which only the in-process backend supports.
+  '''
+  if quantized and backend == 'subprocess':
+    raise ValueError('The subprocess backend does not support quantized models')
 
-    input_str = build_input(from_text, from_token_ranges, to_text, to_token_ranges)
-    print(input_str, file=input_file, flush=True)
+  token_ranges = list(zip(
+    get_token_ranges_many(from_language, [from_text for (from_text, _) in pairs]),
+    get_token_ranges_many(to_language, [to_text for (_, to_text) in pairs])))
 
-    run_awesome(model, input_file.name, output_file.name)
+  if backend == 'subprocess':
+    token_mappings = run_awesome_subprocess(model, pairs, token_ranges)
+  else:
+    items = [
+      (from_text, from_token_ranges, to_text, to_token_ranges)
+      for ((from_text, to_text), (from_token_ranges, to_token_ranges)) in zip(pairs, token_ranges)
+    ]
+    token_mappings = extract_alignments(model, items, quantized) if extract is None else extract(items)
 
-    return parse_output(
-      output_file.readline(),
+  return [
+    token_mappings_to_ranges(
+      mappings,
       from_text,
       from_token_ranges,
       to_text,
       to_token_ranges,
-      simplify_result)
+      simplify_result,
+      simplify_mode)
+    for (mappings, (from_text, to_text), (from_token_ranges, to_token_ranges)) in zip(token_mappings, pairs, token_ranges)
+  ]
+
+def run_awesome_subprocess(
+    model: str,
+    pairs: list[tuple[str, str]],
+    token_ranges: list[tuple[list[tuple[int, int]], list[tuple[int, int]]]]) -> list[list[tuple[int, int]]]:
+  '''Runs awesome_align.run_align once with a line for each pair.'''
+  with NamedTemporaryFile(mode='+w', prefix='awesome-', suffix='.tmp', dir='.') as input_file, \
+       NamedTemporaryFile(mode='+w', prefix='awesome-', suffix='.tmp', dir='.') as output_file:
+
+    for ((from_text, to_text), (from_token_ranges, to_token_ranges)) in zip(pairs, token_ranges):
+      input_str = build_input(from_text, from_token_ranges, to_text, to_token_ranges)
+      print(input_str, file=input_file)
+    input_file.flush()
+
+    run_awesome(model, input_file.name, output_file.name)
+
+    return [parse_token_mappings(output_file.readline()) for _ in pairs]
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -82,9 +290,17 @@ if __name__ == '__main__':
   parser.add_argument('--from-text', type=str, required=True)
   parser.add_argument('--to-language', type=str, required=True, choices=TOKENIZERS.keys())
   parser.add_argument('--to-text', type=str, required=True)
-  parser.add_argument('--model', type=str, default='bert-base-multilingual-cased')
+  parser.add_argument('--model', type=str, default=DEFAULT_MODEL)
   parser.add_argument('--no-simplify', action='store_true', default=False)
+  parser.add_argument('--simplify-mode', type=str, default='greedy', choices=SIMPLIFY_MODES)
+  parser.add_argument('--simplify-time-budget', type=float, default=simplify_exact.DEFAULT_TIME_BUDGET, help='Seconds the exact simplify mode searches for each pair before using the best result so far')
+  parser.add_argument('--backend', type=str, default=DEFAULT_BACKEND, choices=['inprocess', 'subprocess'])
+  parser.add_argument('--quantized', action='store_true', default=False, help='Use dynamic int8 quantization (faster on CPU, see compare_quantized.py)')
+  parser.add_argument('--output-format', type=str, default='text', choices=['text', 'binary'], help='Comma-separated integers, or the format in binary.py')
+  parser.add_argument('--profile', action='store_true', default=False, help='Print the time spent in each stage to stderr')
   args = parser.parse_args()
+  profiling.enabled = args.profile
+  simplify_exact.current_time_budget = args.simplify_time_budget
 
   result = align(
     args.from_language,
@@ -92,7 +308,16 @@ if __name__ == '__main__':
     args.to_language,
     args.to_text,
     args.model,
-    not args.no_simplify)
+    not args.no_simplify,
+    args.backend,
+    args.simplify_mode,
+    quantized=args.quantized)
+
+  if args.output_format == 'binary':
+    sys.stdout.buffer.write(binary.to_bytes([result]))
+  else:
+    print(','.join(str(i) for i in result))
 
-  print(','.join(str(i) for i in result))
+  if args.profile:
+    print(profiling.summary(), file=sys.stderr)
 
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+'''
+Aligns a whole corpus of sentence pairs in a single process.
+
+Pairs are streamed from a file or stdin, either as TSV ("from<TAB>to" per line)
+or JSONL ({"fromText": ..., "toText": ...} per line), and the results are
+written in the same flat format as align.py, one line per pair, as soon as each
+chunk of pairs is done. Only one chunk is held in memory at a time; with
+WSPAlign, the questions for every pair in a chunk are packed together into full
+inference batches regardless of which sentence they came from.
+
+An interrupted job can be restarted with --resume, which skips as many pairs as
+there are complete lines in the output file and appends to it, or from an
+arbitrary pair with --skip. A job that was started with --skip is resumed by
+passing the same --skip along with --resume. Use --workers to spread the
+chunks over several processes. Blank lines in the input are ignored.
+
+--output-format binary writes the compact format of binary.py instead, which
+can be read back with NumPy without parsing, and with --scores (WSPAlign with
+--no-simplify only) the score of each alignment. Binary output can't be resumed.
+'''
+import argparse
+import itertools
+import json
+import os
+import sys
+from typing import Iterable, Iterator, TextIO
+import align as wsp
+import awesome
+import binary
+import profiling
+import simplify_exact
+from simplify import SIMPLIFY_MODES
+
+# Number of pairs aligned together. Larger chunks fill more batches at the cost
+# of memory and of how much work is redone after an interruption.
+DEFAULT_CHUNK_SIZE = 64
+
+# Bytes of the output file read at a time when counting its lines for --resume.
+COUNT_BLOCK_SIZE = 1 << 20
+
+def read_pairs(file: TextIO, input_format: str) -> Iterator[tuple[str, str]]:
+  '''Yields the pairs in the file, skipping blank lines.'''
+  for (number, line) in enumerate(file, 1):
+    line = line.rstrip('\r\n')
+    if not line.strip():
+      continue
+
+    if input_format == 'jsonl':
+      try:
+        obj = json.loads(line)
+        yield (obj['fromText'], obj['toText'])
+      except (ValueError, KeyError, TypeError) as e:
+        raise ValueError(f'Line {number} is not a JSON object with fromText and toText: {e}') from e
+    else:
+      fields = line.split('\t')
+      if len(fields) != 2:
+        raise ValueError(f'Line {number} has {len(fields)} tab-separated fields rather than 2')
+      yield (fields[0], fields[1])
+
+def chunked(pairs: Iterable[tuple[str, str]], chunk_size: int) -> Iterator[list[tuple[str, str]]]:
+  iterator = iter(pairs)
+  while chunk := list(itertools.islice(iterator, chunk_size)):
+    yield chunk
+
+def format_result(result: list[int]) -> str:
+  return ','.join(str(i) for i in result)
+
+class TextWriter:
+  '''Writes one line of comma-separated integers per pair, with the same interface as binary.Writer.'''
+
+  def __init__(self, file: TextIO):
+    self.file = file
+
+  def write(self, result: list[int], scores: Iterable[float] | None = None):
+    self.file.write(format_result(result) + '\n')
+
+  def flush(self):
+    self.file.flush()
+
+  def close(self):
+    self.file.flush()
+
+def count_complete_lines(path: str) -> int:
+  '''
+  Returns the number of complete lines in the file, truncating a partially
+  written last line so that appending to it picks up where it left off.
+  '''
+  if not os.path.exists(path):
+    return 0
+
+  count = 0
+  complete = 0  # Offset just past the last newline
+  position = 0
+
+  # Read in blocks, since the output of a long run may not fit in memory
+  with open(path, 'rb+') as file:
+    while data := file.read(COUNT_BLOCK_SIZE):
+      count += data.count(b'\n')
+      last = data.rfind(b'\n')
+      if last >= 0:
+        complete = position + last + 1
+      position += len(data)
+
+    if complete < position:
+      file.truncate(complete)
+  return count
+
+def align_chunk(args: argparse.Namespace, pairs: list[tuple[str, str]]) -> list[tuple[list[int], list[float] | None]]:
+  '''Returns the alignments of each pair, and their scores if --scores was given.'''
+  if args.scores:
+    scored = wsp.align_many_scored(
+      args.from_language,
+      args.to_language,
+      pairs,
+      args.symmetric,
+      args.batch_size,
+      quantized=args.quantized)
+    return [
+      (s.to_ranges(args.threshold, args.symmetric, args.symmetric_mode), s.scores(args.threshold, args.symmetric, args.symmetric_mode))
+      for s in scored
+    ]
+
+  return [(result, None) for result in align_results(args, pairs)]
+
+def align_results(args: argparse.Namespace, pairs: list[tuple[str, str]]) -> list[list[int]]:
+  match args.method:
+    case 'awesome':
+      return awesome.align_many(
+        args.from_language,
+        args.to_language,
+        pairs,
+        args.model,
+        not args.no_simplify,
+        args.backend,
+        args.simplify_mode,
+        quantized=args.quantized)
+    case _:
+      return wsp.align_many(
+        args.from_language,
+        args.to_language,
+        pairs,
+        args.threshold,
+        args.symmetric,
+        args.symmetric_mode,
+        not args.no_simplify,
+        args.batch_size,
+        args.simplify_mode,
+        args.quantized)
+
+def run(args: argparse.Namespace, input_file: TextIO, writer: TextWriter | binary.Writer, skip: int):
+  pairs = itertools.islice(read_pairs(input_file, args.format), skip, None)
+  done = skip
+
+  for chunk in chunked(pairs, args.chunk_size):
+    for (result, scores) in align_chunk(args, chunk):
+      writer.write(result, scores)
+    writer.flush()
+
+    done += len(chunk)
+    print(f'Aligned {done} pairs', file=sys.stderr)
+
+def add_arguments(parser: argparse.ArgumentParser):
+  parser.add_argument('--method', type=str, default='wsp', choices=['wsp', 'awesome'])
+  parser.add_argument('--from-language', type=str, required=True, choices=wsp.TOKENIZERS.keys())
+  parser.add_argument('--to-language', type=str, required=True, choices=wsp.TOKENIZERS.keys())
+  parser.add_argument('--input', type=str, default='-', help='TSV or JSONL file of sentence pairs, or - for stdin')
+  parser.add_argument('--output', type=str, default='-', help='File to write results to, or - for stdout')
+  parser.add_argument('--format', type=str, default='tsv', choices=['tsv', 'jsonl'])
+  parser.add_argument('--skip', type=int, default=0, help='Number of input pairs to skip; with --resume, those before the ones already in the output')
+  parser.add_argument('--resume', action='store_true', default=False, help='Skip pairs already in the output file and append to it')
+  parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE)
+  parser.add_argument('--threshold', type=float, default=wsp.DEFAULT_THRESHOLD)
+  parser.add_argument('--symmetric', action='store_true', default=False)
+  parser.add_argument('--symmetric-mode', type=str, default='AND', choices=wsp.SYMMETRIC_MODES)
+  parser.add_argument('--batch-size', type=int, default=wsp.DEFAULT_BATCH_SIZE)
+  parser.add_argument('--model', type=str, default=awesome.DEFAULT_MODEL, help='awesome-align model')
+  parser.add_argument('--backend', type=str, default=awesome.DEFAULT_BACKEND, choices=['inprocess', 'subprocess'], help='awesome-align backend')
+  parser.add_argument('--no-simplify', action='store_true', default=False)
+  parser.add_argument('--simplify-mode', type=str, default='greedy', choices=SIMPLIFY_MODES)
+  parser.add_argument('--simplify-time-budget', type=float, default=simplify_exact.DEFAULT_TIME_BUDGET, help='Seconds the exact simplify mode searches for each pair before using the best result so far')
+  parser.add_argument('--quantized', action='store_true', default=False, help='Use dynamic int8 quantization (faster on CPU, see compare_quantized.py)')
+  parser.add_argument('--output-format', type=str, default='text', choices=['text', 'binary'], help='One line of comma-separated integers per pair, or the format in binary.py')
+  parser.add_argument('--scores', action='store_true', default=False, help='Include the score of each alignment (WSPAlign, binary output with --no-simplify only)')
+  parser.add_argument('--workers', type=int, default=1, help='Number of worker processes (see parallel.py)')
+  parser.add_argument('--fork', action='store_true', default=False, help='Load the model once and fork the workers from this process so that they share it')
+  parser.add_argument('--threads-per-worker', type=int, default=None, help='torch threads per worker; defaults to cores / workers')
+  parser.add_argument('--profile', action='store_true', default=False, help='Print the time spent in each stage to stderr')
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  add_arguments(parser)
+  args = parser.parse_args()
+  profiling.enabled = args.profile
+  simplify_exact.current_time_budget = args.simplify_time_budget
+
+  if args.scores and (args.method != 'wsp' or args.output_format != 'binary' or not args.no_simplify):
+    parser.error('--scores requires --method wsp, --output-format binary and --no-simplify')
+
+  skip = args.skip
+  if args.resume:
+    if args.output == '-':
+      parser.error('--resume requires --output')
+    if args.output_format == 'binary':
+      # The offsets are only written once the file is complete
+      parser.error('--resume requires --output-format text')
+    # The output starts at the --skip'th pair, if the run being resumed had one
+    skip += count_complete_lines(args.output)
+
+  input_file = sys.stdin if args.input == '-' else open(args.input, encoding='utf-8')
+  if args.output_format == 'binary':
+    output_file = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    writer = binary.Writer(output_file, args.scores)
+  else:
+    output_file = sys.stdout if args.output == '-' else open(args.output, 'a' if args.resume else 'w', encoding='utf-8')
+    writer = TextWriter(output_file)
+
+  with input_file, output_file:
+    if args.workers > 1:
+      # parallel imports this module, so it can't be imported at the top
+      import parallel
+      parallel.run(args, input_file, writer, skip)
+    else:
+      run(args, input_file, writer, skip)
+    writer.close()
+
+  if args.profile:
+    print(profiling.summary(), file=sys.stderr)
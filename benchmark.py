@@ -0,0 +1,398 @@
+#!/usr/bin/env python3
+'''
+Measures the performance of each stage of alignment and writes the results as
+JSON, so that runs can be compared and regressions caught.
+
+Everything runs offline and reproducibly: the WSPAlign and awesome-align models
+are replaced with tiny BERT models with random (but seeded) weights and a
+vocabulary built from the corpus, which are the same shape of computation as
+the real ones, only smaller. The corpus consists of a few fixed EN/JA sentence
+pairs plus synthetic ones of increasing length. Torch is limited to one thread
+by default, since timings with more threads vary more from run to run.
+
+  ./benchmark.py --output before.json
+  ./benchmark.py --baseline before.json   # exits with 1 if anything is slower
+
+Each benchmark reports the min, median, and mean of its runs in seconds; only
+the min is compared against the baseline, as it's the least noisy.
+
+The startup/ benchmarks each run a fresh Python process, to measure the import
+time that short CLI runs and respawned workers pay before doing any work, and
+the time to load each model from its checkpoint and from a snapshot (see
+snapshot.py).
+'''
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Callable
+import align
+import awesome
+import document
+import models
+import simplify
+import simplify_exact
+import simplify_slow
+import snapshot
+
+# Fixed sentence pairs, similar to those in KFTT.
+CORPUS = [
+  ('瑞鳳です。軽空母ですが、練度が上がれば、正規空母並の活躍をお見せできます。',
+   "I'm Zuihou. Even though I'm a light carrier, I can show you that I'll be as good as standard carriers with some experience."),
+  ('金閣寺は京都市北区にある臨済宗相国寺派の寺院である。',
+   'Kinkaku-ji is a temple of the Shokoku-ji school of the Rinzai sect in Kita Ward, Kyoto City.'),
+  ('この庭園は室町時代に作られ、現在は特別名勝に指定されている。',
+   'The garden was built in the Muromachi period and is now designated a Special Place of Scenic Beauty.'),
+  ('彼は若い頃に比叡山で学び、後に自らの宗派を開いた。',
+   'He studied on Mt. Hiei in his youth and later founded his own sect.'),
+]
+
+# Words the synthetic sentences are made of.
+EN_WORDS = 'the temple was built by a monk in Kyoto during period and is now famous for its garden'.split()
+JA_WORDS = ['寺', 'は', '僧', 'が', '京都', 'に', '時代', 'で', '建て', 'られ', 'た', '庭園', 'で', '有名', 'です', '。']
+
+# Number of words in each synthetic sentence.
+SYNTHETIC_LENGTHS = [8, 16, 32, 64]
+
+# Examples from simplify_slow.py.
+SIMPLIFY_EXAMPLES = [
+  [0,1,0,2,1,2,0,2,2,3,0,2,0,2,2,3,2,3,0,3],
+  [0,1,0,2,0,1,1,3,1,2,1,3,2,3,1,3,3,4,1,3,1,2,0,3],
+]
+
+# Number of sentences in each document aligned by document.py, made by
+# repeating the corpus.
+DOCUMENT_SENTENCES = [4, 16, 64]
+
+# Code run in a new process by each startup benchmark.
+STARTUP = {
+  'import-align': 'import align',
+  'import-awesome': 'import awesome',
+  'import-visualize': 'import visualize',
+  'import-parallel': 'import parallel',
+  'tokenize-en': 'import align; align.get_token_ranges("en", "The temple is famous.")',
+  'tokenize-ja': 'import align; align.get_token_ranges("ja", "寺は有名です。")',
+}
+
+# Number of timed runs of the startup benchmarks, which take seconds each.
+STARTUP_REPEAT = 3
+
+def synthetic_pair(rng: random.Random, length: int) -> tuple[str, str]:
+  from_text = ''.join(rng.choice(JA_WORDS) for _ in range(length))
+  to_text = ' '.join(rng.choice(EN_WORDS) for _ in range(length)).capitalize() + '.'
+  return (from_text, to_text)
+
+def synthetic_alignments(rng: random.Random, length: int) -> tuple[list[int], str, str]:
+  '''
+  Mostly-monotonic alignments between words with some reordering, in both
+  directions, like the output of align.py with --symmetric-mode OR.
+  '''
+  from_words = [rng.choice(EN_WORDS) for _ in range(length)]
+  from_text = ' '.join(from_words)
+  from_ranges = []
+  for word in from_words:
+    start = from_ranges[-1][1] + 1 if from_ranges else 0
+    from_ranges.append((start, start + len(word)))
+
+  to_words = [rng.choice(JA_WORDS) for _ in range(length)]
+  to_text = ''.join(to_words)
+  to_ranges = []
+  for word in to_words:
+    start = to_ranges[-1][1] if to_ranges else 0
+    to_ranges.append((start, start + len(word)))
+
+  order = list(range(length))
+  for i in range(length - 1):
+    if rng.random() < 0.2:
+      order[i], order[i + 1] = order[i + 1], order[i]
+
+  alignments: list[int] = []
+  for i, j in enumerate(order):
+    k = min(length - 1, j + (rng.random() < 0.3))
+    alignments += [*from_ranges[i], to_ranges[j][0], to_ranges[k][1]]
+    k = min(length - 1, i + (rng.random() < 0.3))
+    alignments += [from_ranges[i][0], from_ranges[k][1], *to_ranges[j]]
+
+  return alignments, from_text, to_text
+
+def build_vocab(path: str, texts: list[str]) -> str:
+  '''Writes a vocab.txt with every character in the texts, plus subwords.'''
+  chars = sorted(set(''.join(texts)) - set(' '))
+  words = sorted(set(w for text in texts for w in text.split()))
+  vocab = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]', align.MARKER.strip(), *chars, *('##' + c for c in chars), *words]
+  vocab_path = os.path.join(path, 'vocab.txt')
+  with open(vocab_path, 'w', encoding='utf-8') as file:
+    file.write('\n'.join(dict.fromkeys(vocab)))
+  return vocab_path
+
+def build_wsp_model(path: str, vocab_path: str, seed: int) -> str:
+  '''Saves a tiny random-weight BERT question-answering model.'''
+  import torch
+  from transformers import BertConfig, BertForQuestionAnswering, BertTokenizerFast
+
+  model_path = os.path.join(path, 'wsp')
+  tokenizer = BertTokenizerFast(vocab_path, do_lower_case=False)
+  config = BertConfig(
+    vocab_size=len(tokenizer),
+    hidden_size=64,
+    num_hidden_layers=2,
+    num_attention_heads=2,
+    intermediate_size=128)
+
+  torch.manual_seed(seed)
+  BertForQuestionAnswering(config).save_pretrained(model_path)
+  tokenizer.save_pretrained(model_path)
+  return model_path
+
+def build_awesome_model(path: str, vocab_path: str, seed: int) -> str:
+  '''Saves a tiny random-weight BERT model with enough layers for ALIGN_LAYER.'''
+  import torch
+  if models.AWESOME_PATH not in sys.path:
+    sys.path.append(models.AWESOME_PATH)
+  from awesome_align.configuration_bert import BertConfig
+  from awesome_align.modeling import BertForMaskedLM
+  from awesome_align.tokenization_bert import BertTokenizer
+
+  model_path = os.path.join(path, 'awesome')
+  os.makedirs(model_path, exist_ok=True)
+  tokenizer = BertTokenizer(vocab_path, do_lower_case=False)
+  config = BertConfig(
+    vocab_size=len(tokenizer.vocab),
+    hidden_size=64,
+    num_hidden_layers=awesome.ALIGN_LAYER + 1,
+    num_attention_heads=2,
+    intermediate_size=128)
+
+  torch.manual_seed(seed)
+  BertForMaskedLM(config).save_pretrained(model_path)
+  tokenizer.save_pretrained(model_path)
+  return model_path
+
+class Unavailable(Exception):
+  '''A model needed by the benchmark can't be built, e.g. without the awesome-align submodule.'''
+
+class BenchmarkModels:
+  '''Builds the tiny models, and their snapshots, the first time a benchmark needs them.'''
+
+  def __init__(self, path: str, texts: list[str], seed: int):
+    self.path = path
+    self.texts = texts
+    self.seed = seed
+    self.built: dict[str, str | Unavailable] = {}
+
+  def get(self, name: str, build: Callable[[], str]) -> str:
+    '''Returns the path built by `build`, building it only once, or raises Unavailable.'''
+    if name not in self.built:
+      try:
+        self.built[name] = build()
+      except (ImportError, OSError) as e:
+        self.built[name] = Unavailable(f'{name} model: {e}')
+    if isinstance(self.built[name], Unavailable):
+      raise self.built[name]
+    return self.built[name]
+
+  def vocab(self) -> str:
+    return self.get('vocab', lambda: build_vocab(self.path, self.texts))
+
+  def wsp(self) -> str:
+    '''Returns the WSPAlign model, which is also made align.MODEL.'''
+    align.MODEL = self.get('wsp', lambda: build_wsp_model(self.path, self.vocab(), self.seed))
+    return align.MODEL
+
+  def awesome(self) -> str:
+    return self.get('awesome', lambda: build_awesome_model(self.path, self.vocab(), self.seed))
+
+  def snapshots(self, kind: str) -> str:
+    '''Returns the directory with a snapshot of the model of the kind.'''
+    path = os.path.join(self.path, 'snapshots')
+    model = self.wsp() if kind == 'wsp' else self.awesome()
+    self.get(f'{kind}-snapshot', lambda: snapshot.save(kind, model, path))
+    return path
+
+def measure(fn: Callable[[], Any], repeat: int, setup: Callable[[], Any] | None = None) -> dict[str, Any]:
+  '''Runs `fn` once to warm up, then `repeat` times, calling `setup` untimed before each.'''
+  if setup is not None:
+    setup()
+  fn()
+
+  times: list[float] = []
+  for _ in range(repeat):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+
+  return {
+    'min': min(times),
+    'median': statistics.median(times),
+    'mean': statistics.mean(times),
+    'runs': repeat,
+  }
+
+def run_python(code: str, env: dict[str, str] | None = None):
+  '''Runs the code in a new Python process in this directory, with `env` added to the environment.'''
+  subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__)), env={ **os.environ, **(env or {}) }, check=True)
+
+def get_benchmarks(args: argparse.Namespace, models_path: str) -> dict[str, tuple[Callable[[], Any], Callable[[], Any] | None]]:
+  '''Returns the benchmarks by name, each as (fn, setup).'''
+  rng = random.Random(args.seed)
+  pairs = [*(('fixed', i, pair) for i, pair in enumerate(CORPUS)), *(('synthetic', n, synthetic_pair(rng, n)) for n in SYNTHETIC_LENGTHS)]
+  benchmarks: dict[str, tuple[Callable[[], Any], Callable[[], Any] | None]] = {}
+
+  for name, code in STARTUP.items():
+    benchmarks[f'startup/{name}'] = (lambda c=code: run_python(c), None)
+
+  for kind, n, (from_text, to_text) in pairs:
+    name = f'{kind}-{n}'
+    benchmarks[f'tokenize/ja/{name}'] = (lambda t=from_text: align.get_token_ranges('ja', t), align.token_cache.clear)
+    benchmarks[f'tokenize/en/{name}'] = (lambda t=to_text: align.get_token_ranges('en', t), align.token_cache.clear)
+
+  from_texts = [from_text for (_, _, (from_text, _)) in pairs]
+  to_texts = [to_text for (_, _, (_, to_text)) in pairs]
+  benchmarks['tokenize_many/ja'] = (lambda: align.get_token_ranges_many('ja', from_texts), align.token_cache.clear)
+  benchmarks['tokenize_many/en'] = (lambda: align.get_token_ranges_many('en', to_texts), align.token_cache.clear)
+  benchmarks['tokenize_many/ja/cached'] = (lambda: align.get_token_ranges_many('ja', from_texts), None)
+
+  if not args.skip_models:
+    # The models are built by the setup of the first benchmark that uses them,
+    # so that filtering out the benchmarks that need one skips building it
+    test_models = BenchmarkModels(models_path, [text for (_, _, pair) in pairs for text in pair], args.seed)
+    get_model = { 'wsp': test_models.wsp, 'awesome': test_models.awesome }
+
+    for kind in get_model:
+      load = lambda k=kind: f'import models; models.get({k!r}, {get_model[k]()!r})'
+      benchmarks[f'startup/load-{kind}'] = (lambda l=load: run_python(l()), get_model[kind])
+      benchmarks[f'startup/load-{kind}-snapshot'] = (
+        lambda l=load, k=kind: run_python(l(), { 'MODEL_SNAPSHOTS': test_models.snapshots(k) }),
+        lambda k=kind: test_models.snapshots(k))
+
+    for kind, n, (from_text, to_text) in pairs:
+      name = f'{kind}-{n}'
+      # Tokenized in the setup, after the model it tokenizes for is built
+      token_ranges: dict[str, Any] = {}
+      def tokenize(r=token_ranges, a=from_text, b=to_text):
+        test_models.wsp()
+        r.update(ja=align.get_token_ranges('ja', a), en=align.get_token_ranges('en', b))
+      benchmarks[f'align_forward/{name}'] = (
+        lambda r=token_ranges, a=from_text, b=to_text: align.align_forward(r['ja'], r['en'], a, b),
+        tokenize)
+      benchmarks[f'awesome/{name}'] = (
+        lambda a=from_text, b=to_text: awesome.align('ja', a, 'en', b, test_models.awesome(), simplify_result=False),
+        lambda: (test_models.awesome(), awesome.embedding_cache.clear()))
+
+    for n in DOCUMENT_SENTENCES:
+      sentences = [CORPUS[i % len(CORPUS)] for i in range(n)]
+      from_document = '\n'.join(from_text for (from_text, _) in sentences)
+      to_document = '\n'.join(to_text for (_, to_text) in sentences)
+      benchmarks[f'document/{n}-sentences'] = (
+        lambda a=from_document, b=to_document: document.align('ja', a, 'en', b, simplify_result=False),
+        test_models.wsp)
+
+  for i, alignments in enumerate(SIMPLIFY_EXAMPLES):
+    benchmarks[f'simplify/example-{i}'] = (lambda a=alignments: simplify.simplify(a, 'abcd', 'abcd'), None)
+    benchmarks[f'simplify_exact/example-{i}'] = (lambda a=alignments: simplify_exact.simplify(a, 'abcd', 'abcd'), None)
+    benchmarks[f'simplify_slow/example-{i}'] = (lambda a=alignments: simplify_slow.simplify(a, 'abcd', 'abcd'), None)
+
+  for n in SYNTHETIC_LENGTHS:
+    alignments, from_text, to_text = synthetic_alignments(rng, n)
+    benchmarks[f'simplify/synthetic-{n}'] = (lambda a=alignments, f=from_text, t=to_text: simplify.simplify(a, f, t), None)
+    benchmarks[f'simplify_exact/synthetic-{n}'] = (lambda a=alignments, f=from_text, t=to_text: simplify_exact.simplify(a, f, t), None)
+
+  return benchmarks
+
+def get_environment(args: argparse.Namespace) -> dict[str, Any]:
+  import numpy
+  import torch
+  import transformers
+  return {
+    'python': platform.python_version(),
+    'platform': platform.platform(),
+    'processor': platform.processor(),
+    'cpus': os.cpu_count(),
+    'threads': args.threads,
+    'seed': args.seed,
+    'numpy': numpy.__version__,
+    'torch': torch.__version__,
+    'transformers': transformers.__version__,
+  }
+
+def compare(results: dict[str, Any], baseline: dict[str, Any], tolerance: float) -> list[str]:
+  '''Prints each benchmark's change from the baseline and returns those that regressed.'''
+  regressions: list[str] = []
+
+  for name, result in results['benchmarks'].items():
+    if name not in baseline['benchmarks']:
+      continue
+    before = baseline['benchmarks'][name]['min']
+    after = result['min']
+    ratio = after / before if before > 0 else 1
+    regressed = ratio > 1 + tolerance
+    if regressed:
+      regressions.append(name)
+    print(f'{name:40} {before * 1000:10.3f}ms -> {after * 1000:10.3f}ms ({ratio:.2f}x){"  REGRESSION" if regressed else ""}', file=sys.stderr)
+
+  return regressions
+
+def run(args: argparse.Namespace) -> dict[str, Any]:
+  import torch
+  torch.set_num_threads(args.threads)
+  random.seed(args.seed)
+
+  results: dict[str, Any] = { 'environment': get_environment(args), 'benchmarks': {} }
+
+  with tempfile.TemporaryDirectory(prefix='benchmark-') as models_path:
+    for name, (fn, setup) in get_benchmarks(args, models_path).items():
+      if args.filter and args.filter not in name:
+        continue
+      if name.startswith('simplify_slow/'):
+        repeat = 1
+      elif name.startswith('startup/'):
+        repeat = min(args.repeat, STARTUP_REPEAT)
+      else:
+        repeat = args.repeat
+      try:
+        results['benchmarks'][name] = measure(fn, repeat, setup)
+      except Unavailable as e:
+        print(f'{name:40} skipped, no {e}', file=sys.stderr)
+        continue
+      print(f'{name:40} {results["benchmarks"][name]["min"] * 1000:10.3f}ms', file=sys.stderr)
+
+    results['models'] = models.stats()
+
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--output', type=str, default='-', help='File to write the JSON results to, or - for stdout')
+  parser.add_argument('--baseline', type=str, default=None, help='Results of a previous run to compare against')
+  parser.add_argument('--tolerance', type=float, default=0.25, help='Fraction slower than the baseline counted as a regression')
+  parser.add_argument('--repeat', type=int, default=10, help='Number of timed runs of each benchmark')
+  parser.add_argument('--filter', type=str, default=None, help='Only run benchmarks whose name contains this')
+  parser.add_argument('--threads', type=int, default=1, help='torch threads')
+  parser.add_argument('--seed', type=int, default=0)
+  parser.add_argument('--skip-models', action='store_true', default=False, help='Skip the benchmarks that need torch models')
+  args = parser.parse_args()
+
+  results = run(args)
+
+  output = json.dumps(results, indent=2)
+  if args.output == '-':
+    print(output)
+  else:
+    with open(args.output, 'w', encoding='utf-8') as file:
+      file.write(output + '\n')
+
+  if args.baseline is not None:
+    with open(args.baseline, encoding='utf-8') as file:
+      baseline = json.load(file)
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+      print(f'{len(regressions)} benchmarks regressed: {", ".join(regressions)}', file=sys.stderr)
+      sys.exit(1)
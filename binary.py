@@ -0,0 +1,125 @@
+'''
+Compact binary format for alignment results.
+
+The text format written by align.py and batch.py ("1,2,3,4,...", one line per
+pair) has to be formatted and parsed one number at a time, which for a whole
+corpus takes longer than the I/O itself and several times the memory. This
+format stores the alignments as packed int32s that NumPy reads without parsing
+or copying, by memory-mapping the file:
+
+  alignments = binary.read('results.bin')
+  alignments[i]            # (k, 4) array of from_start, from_end, to_start, to_end of pair i
+  alignments.get_scores(i) # (k,) scores of those alignments, if the file has them
+  alignments.ranges        # every alignment of every pair, as a single (n, 4) array
+
+The file is written as the results come in, so the per-pair offsets are at the
+end rather than in the header. All values are little-endian:
+
+  header   b'ALN1', uint32 flags (1 = has scores)
+  records  n × (int32 from_start, from_end, to_start, to_end[, float32 score])
+  offsets  (pairs + 1) × int64, the index of each pair's first record
+  footer   int64 pairs, int64 n
+'''
+import io
+from array import array
+from collections.abc import Sequence
+from typing import BinaryIO, Iterable
+import numpy as np
+
+MAGIC = b'ALN1'
+
+# Content type of the format, for the Accept header of /align.
+MIME_TYPE = 'application/x-alignments'
+
+HAS_SCORES = 1
+
+HEADER_SIZE = 8
+FOOTER_SIZE = 16
+
+RANGES = np.dtype([('ranges', '<i4', (4,))])
+SCORED_RANGES = np.dtype([('ranges', '<i4', (4,)), ('score', '<f4')])
+
+class Writer:
+  '''Writes results one pair at a time to a binary file; `close` writes the offsets.'''
+
+  def __init__(self, file: BinaryIO, scores: bool = False):
+    self.file = file
+    self.has_scores = scores
+    self.dtype = SCORED_RANGES if scores else RANGES
+    self.offsets = array('q', [0])
+    self.file.write(MAGIC + np.uint32(HAS_SCORES if scores else 0).astype('<u4').tobytes())
+
+  def write(self, result: list[int] | np.ndarray, scores: Iterable[float] | None = None):
+    ranges = np.asarray(result, dtype=np.int32).reshape(-1, 4)
+    records = np.empty(len(ranges), dtype=self.dtype)
+    records['ranges'] = ranges
+    if self.has_scores:
+      assert scores is not None, 'The file was opened with scores'
+      records['score'] = np.fromiter(scores, dtype=np.float32, count=len(ranges))
+    self.file.write(records.tobytes())
+    self.offsets.append(self.offsets[-1] + len(ranges))
+
+  def flush(self):
+    self.file.flush()
+
+  def close(self):
+    '''Writes the offsets and footer, after which the file is complete. Doesn't close `file`.'''
+    self.file.write(np.asarray(self.offsets, dtype='<i8').tobytes())
+    self.file.write(np.array([len(self.offsets) - 1, self.offsets[-1]], dtype='<i8').tobytes())
+    self.file.flush()
+
+  def __enter__(self) -> 'Writer':
+    return self
+
+  def __exit__(self, *exc_info):
+    self.close()
+
+class Alignments(Sequence[np.ndarray]):
+  '''The results in a binary file or buffer, as views of it rather than copies.'''
+
+  def __init__(self, buffer):
+    if bytes(buffer[:4]) != MAGIC:
+      raise ValueError('Not a binary alignment file')
+    flags = int(np.frombuffer(buffer, dtype='<u4', count=1, offset=4)[0])
+    (pairs, count) = np.frombuffer(buffer, dtype='<i8', count=2, offset=len(buffer) - FOOTER_SIZE).tolist()
+
+    dtype = SCORED_RANGES if flags & HAS_SCORES else RANGES
+    self.records = np.frombuffer(buffer, dtype=dtype, count=count, offset=HEADER_SIZE)
+    self.offsets = np.frombuffer(buffer, dtype='<i8', count=pairs + 1, offset=HEADER_SIZE + count * dtype.itemsize)
+    self.ranges = self.records['ranges']
+    self.scores = self.records['score'] if flags & HAS_SCORES else None
+
+  def __len__(self) -> int:
+    return len(self.offsets) - 1
+
+  def __getitem__(self, index):
+    if isinstance(index, slice):
+      return [self[i] for i in range(*index.indices(len(self)))]
+    if index < 0:
+      index += len(self)
+    if not 0 <= index < len(self):
+      raise IndexError(index)
+    return self.ranges[self.offsets[index]:self.offsets[index + 1]]
+
+  def get_scores(self, index: int) -> np.ndarray | None:
+    '''Returns the score of each of the pair's alignments, or None if the file has no scores.'''
+    if self.scores is None:
+      return None
+    return self.scores[self.offsets[index]:self.offsets[index + 1]]
+
+  def to_list(self, index: int) -> list[int]:
+    '''Returns the pair's alignments in the same flat format as align.py.'''
+    return self[index].reshape(-1).tolist()
+
+def read(path: str) -> Alignments:
+  return Alignments(np.memmap(path, dtype=np.uint8, mode='r'))
+
+def from_bytes(data: bytes) -> Alignments:
+  return Alignments(np.frombuffer(data, dtype=np.uint8))
+
+def to_bytes(results: list[list[int]], scores: list[Iterable[float]] | None = None) -> bytes:
+  file = io.BytesIO()
+  with Writer(file, scores is not None) as writer:
+    for (i, result) in enumerate(results):
+      writer.write(result, scores[i] if scores is not None else None)
+  return file.getvalue()
@@ -0,0 +1,248 @@
+'''
+A thread-safe, size-bounded LRU cache with an optional on-disk tier.
+
+Entries are evicted least recently used first once their total size exceeds
+`max_bytes`. The size of an entry is that of its value, as measured by
+`size_of`, plus its key and the cache's own bookkeeping for it, so that many
+small values with long keys (such as texts) are still bounded.
+
+If a disk store is given, evicted entries are written to it and read back on a
+later miss ("spill"), or, with `write_through`, every entry is written as soon
+as it's added so the disk tier survives restarts.
+
+Hit and miss counters are kept so the cache can be sized from real traffic.
+'''
+import hashlib
+import json
+import os
+import sqlite3
+import sys
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Callable, Hashable, Protocol
+
+# Bytes used by the cache for each entry besides its key and value: the slot in
+# the ordered dict and its link, and the (value, size) tuple.
+ENTRY_OVERHEAD = 200
+
+def key_size(key: Hashable) -> int:
+  '''Returns the size of a key, including each of its parts if it's a tuple.'''
+  if isinstance(key, tuple):
+    return sys.getsizeof(key) + sum(key_size(part) for part in key)
+  return sys.getsizeof(key)
+
+class Store(Protocol):
+  def get(self, key: Hashable) -> Any | None: ...
+  def put(self, key: Hashable, value: Any): ...
+
+class DirectoryStore:
+  '''
+  Stores each entry in its own file, named by a hash of the key. If `max_bytes`
+  is given, the least recently used files are deleted once they together
+  exceed it, down to `EVICT_TO` of it so that the directory isn't listed again
+  on every write; otherwise the directory grows without bound.
+  '''
+
+  # Fraction of max_bytes that eviction deletes files down to.
+  EVICT_TO = 0.9
+
+  def __init__(self, path: str, save: Callable[[Any, str], None], load: Callable[[str], Any], max_bytes: int | None = None):
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self.save = save
+    self.load = load
+    self.max_bytes = max_bytes
+    self._bytes = sum(entry.stat().st_size for entry in os.scandir(path) if entry.is_file())
+    self._lock = Lock()
+
+  def get_path(self, key: Hashable) -> str:
+    return os.path.join(self.path, hashlib.sha256(repr(key).encode('utf-8')).hexdigest())
+
+  def get(self, key: Hashable) -> Any | None:
+    path = self.get_path(key)
+    try:
+      value = self.load(path)
+    except FileNotFoundError:
+      return None
+    if self.max_bytes is not None:
+      # The modification time is when it was last used, for eviction
+      try:
+        os.utime(path)
+      except FileNotFoundError:
+        pass
+    return value
+
+  def put(self, key: Hashable, value: Any):
+    # Write to a temp file first so a crash can't leave a truncated entry
+    path = self.get_path(key)
+    self.save(value, path + '.tmp')
+    size = os.path.getsize(path + '.tmp')
+    with self._lock:
+      replaced = os.path.getsize(path) if os.path.exists(path) else 0
+      os.replace(path + '.tmp', path)
+      self._bytes += size - replaced
+      if self.max_bytes is not None and self._bytes > self.max_bytes:
+        self._evict()
+
+  def _evict(self):
+    '''Deletes the least recently used files until the rest fit in EVICT_TO of max_bytes.'''
+    entries = sorted(
+      (entry.stat().st_mtime, entry.stat().st_size, entry.path)
+      for entry in os.scandir(self.path) if entry.is_file() and not entry.name.endswith('.tmp'))
+    for (_, size, path) in entries:
+      if self._bytes <= self.max_bytes * self.EVICT_TO:
+        break
+      try:
+        os.remove(path)
+      except FileNotFoundError:
+        continue
+      self._bytes -= size
+
+class SqliteStore:
+  '''
+  Stores JSON-serializable entries in a SQLite database. If `max_bytes` is
+  given, the least recently used entries are deleted once the keys and values
+  together exceed it.
+  '''
+
+  def __init__(self, path: str, max_bytes: int | None = None):
+    self.max_bytes = max_bytes
+    self._connection = sqlite3.connect(path, check_same_thread=False)
+    self._connection.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+    # Databases written before entries had a size and access time get them
+    # added, with the entries used in the order they were written
+    columns = { row[1] for row in self._connection.execute('PRAGMA table_info(cache)') }
+    if 'size' not in columns:
+      self._connection.execute('ALTER TABLE cache ADD COLUMN size INTEGER NOT NULL DEFAULT 0')
+      self._connection.execute('UPDATE cache SET size = length(CAST(key AS BLOB)) + length(CAST(value AS BLOB))')
+    if 'accessed' not in columns:
+      self._connection.execute('ALTER TABLE cache ADD COLUMN accessed INTEGER NOT NULL DEFAULT 0')
+      self._connection.execute('UPDATE cache SET accessed = rowid')
+    self._connection.execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed)')
+    self._connection.commit()
+    (self._bytes, self._clock) = self._connection.execute('SELECT coalesce(sum(size), 0), coalesce(max(accessed), 0) FROM cache').fetchone()
+    self._lock = Lock()
+
+  def get(self, key: Hashable) -> Any | None:
+    key_text = json.dumps(key)
+    with self._lock:
+      row = self._connection.execute('SELECT value FROM cache WHERE key = ?', (key_text,)).fetchone()
+      if row is not None and self.max_bytes is not None:
+        self._clock += 1
+        self._connection.execute('UPDATE cache SET accessed = ? WHERE key = ?', (self._clock, key_text))
+        self._connection.commit()
+    return json.loads(row[0]) if row is not None else None
+
+  def put(self, key: Hashable, value: Any):
+    (key_text, value_text) = (json.dumps(key), json.dumps(value))
+    size = len(key_text.encode('utf-8')) + len(value_text.encode('utf-8'))
+    with self._lock:
+      replaced = self._connection.execute('SELECT size FROM cache WHERE key = ?', (key_text,)).fetchone()
+      self._clock += 1
+      self._connection.execute(
+        'INSERT OR REPLACE INTO cache (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+        (key_text, value_text, size, self._clock))
+      self._bytes += size - (replaced[0] if replaced is not None else 0)
+      if self.max_bytes is not None and self._bytes > self.max_bytes:
+        self._evict()
+      self._connection.commit()
+
+  def _evict(self):
+    '''Deletes the least recently used entries until the rest fit in max_bytes.'''
+    excess = self._bytes - self.max_bytes
+    (freed, evicted) = (0, [])
+    rows = self._connection.execute('SELECT rowid, size FROM cache ORDER BY accessed, rowid')
+    for (rowid, size) in rows:
+      if freed >= excess:
+        break
+      freed += size
+      evicted.append((rowid,))
+    rows.close()
+    # By rowid rather than by access time, which entries can share, so that
+    # exactly the entries counted are deleted
+    self._connection.executemany('DELETE FROM cache WHERE rowid = ?', evicted)
+    self._bytes -= freed
+
+class LRUCache:
+  def __init__(
+    self,
+    max_bytes: int,
+    size_of: Callable[[Any], int] = sys.getsizeof,
+    store: Store | None = None,
+    write_through: bool = False):
+    self.max_bytes = max_bytes
+    self.size_of = size_of
+    self.store = store
+    self.write_through = write_through
+    self.hits = 0
+    self.disk_hits = 0
+    self.misses = 0
+    self._entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+    self._bytes = 0
+    self._lock = Lock()
+
+  def get(self, key: Hashable) -> Any | None:
+    with self._lock:
+      if key in self._entries:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return self._entries[key][0]
+
+    value = self.store.get(key) if self.store is not None else None
+
+    with self._lock:
+      if value is None:
+        self.misses += 1
+        return None
+      self.disk_hits += 1
+      evicted = self._add(key, value)
+
+    self._spill(evicted)
+    return value
+
+  def put(self, key: Hashable, value: Any):
+    if self.write_through and self.store is not None:
+      self.store.put(key, value)
+
+    with self._lock:
+      evicted = self._add(key, value)
+
+    self._spill(evicted)
+
+  def _spill(self, evicted: list[tuple[Hashable, Any]]):
+    '''Writes the entries evicted from memory to the store, outside the lock.'''
+    if not self.write_through and self.store is not None:
+      for evicted_key, evicted_value in evicted:
+        self.store.put(evicted_key, evicted_value)
+
+  def _add(self, key: Hashable, value: Any) -> list[tuple[Hashable, Any]]:
+    if key in self._entries:
+      self._bytes -= self._entries.pop(key)[1]
+
+    size = ENTRY_OVERHEAD + key_size(key) + self.size_of(value)
+    self._entries[key] = (value, size)
+    self._bytes += size
+
+    evicted: list[tuple[Hashable, Any]] = []
+    while self._bytes > self.max_bytes and self._entries:
+      evicted_key, (evicted_value, evicted_size) = self._entries.popitem(last=False)
+      self._bytes -= evicted_size
+      evicted.append((evicted_key, evicted_value))
+
+    return evicted
+
+  def clear(self):
+    with self._lock:
+      self._entries.clear()
+      self._bytes = 0
+
+  def stats(self) -> dict[str, Any]:
+    with self._lock:
+      return {
+        'entries': len(self._entries),
+        'bytes': self._bytes,
+        'maxBytes': self.max_bytes,
+        'hits': self.hits,
+        'diskHits': self.disk_hits,
+        'misses': self.misses,
+      }
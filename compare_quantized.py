@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+'''
+Reports how much faster the int8 quantized models are (see models.py) and how
+closely their alignments agree with the full-precision ones.
+
+Both versions of the model align the same sample corpus, which is the fixed
+sentence pairs from benchmark.py unless a TSV or JSONL file of pairs is given
+(in the same format as batch.py). Agreement is measured on the unsimplified
+alignments, since simplifying can turn a small difference into a large one:
+taking the full-precision alignments as the reference, it reports the
+precision, recall, and F1 of the quantized ones, and the fraction of pairs
+whose alignments are identical.
+
+  ./compare_quantized.py --method wsp
+  ./compare_quantized.py --method awesome --input sample.tsv --from-language en --to-language ja
+
+Exits with 1 if the F1 is below --min-agreement.
+'''
+import argparse
+import json
+import sys
+from typing import Any
+import align as wsp
+import awesome
+import batch
+import benchmark
+import models
+
+def align_corpus(args: argparse.Namespace, pairs: list[tuple[str, str]], quantized: bool) -> list[list[int]]:
+  match args.method:
+    case 'awesome':
+      return awesome.align_many(
+        args.from_language,
+        args.to_language,
+        pairs,
+        args.model,
+        simplify_result=False,
+        quantized=quantized)
+    case _:
+      return wsp.align_many(
+        args.from_language,
+        args.to_language,
+        pairs,
+        args.threshold,
+        args.symmetric,
+        args.symmetric_mode,
+        simplify_result=False,
+        batch_size=args.batch_size,
+        quantized=quantized)
+
+def as_alignment_set(result: list[int]) -> set[tuple[int, int, int, int]]:
+  return { tuple(result[i:i + 4]) for i in range(0, len(result), 4) }
+
+def agreement(expected: list[list[int]], actual: list[list[int]]) -> dict[str, float]:
+  '''Precision, recall, and F1 of `actual` against `expected` over every pair.'''
+  matched = 0
+  expected_total = 0
+  actual_total = 0
+  identical = 0
+
+  for (a, b) in zip(expected, actual):
+    a, b = as_alignment_set(a), as_alignment_set(b)
+    matched += len(a & b)
+    expected_total += len(a)
+    actual_total += len(b)
+    identical += a == b
+
+  precision = matched / actual_total if actual_total else 1.0
+  recall = matched / expected_total if expected_total else 1.0
+  return {
+    'precision': precision,
+    'recall': recall,
+    'f1': 2 * precision * recall / (precision + recall) if precision + recall else 0.0,
+    'identical': identical / len(expected) if expected else 1.0,
+  }
+
+def run(args: argparse.Namespace, pairs: list[tuple[str, str]]) -> dict[str, Any]:
+  import torch
+  torch.set_num_threads(args.threads)
+
+  results: dict[str, Any] = { 'method': args.method, 'pairs': len(pairs) }
+  outputs: dict[str, list[list[int]]] = {}
+
+  for (name, quantized) in [('fp32', False), ('int8', True)]:
+    results[name] = benchmark.measure(
+      lambda q=quantized: outputs.__setitem__(name, align_corpus(args, pairs, q)),
+      args.repeat,
+      awesome.embedding_cache.clear)
+    print(f'{name}: {results[name]["min"] * 1000:.3f}ms', file=sys.stderr)
+
+  results['speedup'] = results['fp32']['min'] / results['int8']['min']
+  results['agreement'] = agreement(outputs['fp32'], outputs['int8'])
+  results['models'] = models.stats()
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--method', type=str, default='wsp', choices=['wsp', 'awesome'])
+  parser.add_argument('--input', type=str, default=None, help='TSV or JSONL file of sentence pairs; defaults to the pairs in benchmark.py')
+  parser.add_argument('--format', type=str, default='tsv', choices=['tsv', 'jsonl'])
+  parser.add_argument('--from-language', type=str, default='ja', choices=wsp.TOKENIZERS.keys())
+  parser.add_argument('--to-language', type=str, default='en', choices=wsp.TOKENIZERS.keys())
+  parser.add_argument('--threshold', type=float, default=wsp.DEFAULT_THRESHOLD)
+  parser.add_argument('--symmetric', action='store_true', default=False)
+  parser.add_argument('--symmetric-mode', type=str, default='AND', choices=wsp.SYMMETRIC_MODES)
+  parser.add_argument('--batch-size', type=int, default=wsp.DEFAULT_BATCH_SIZE)
+  parser.add_argument('--wsp-model', type=str, default=wsp.MODEL, help='WSPAlign model')
+  parser.add_argument('--model', type=str, default=awesome.DEFAULT_MODEL, help='awesome-align model')
+  parser.add_argument('--repeat', type=int, default=3, help='Number of timed runs over the corpus')
+  parser.add_argument('--threads', type=int, default=1, help='torch threads')
+  parser.add_argument('--min-agreement', type=float, default=0.95, help='Lowest acceptable F1 against the full-precision model')
+  args = parser.parse_args()
+  wsp.MODEL = args.wsp_model
+
+  if args.input is None:
+    pairs = benchmark.CORPUS
+  else:
+    with open(args.input, encoding='utf-8') as file:
+      pairs = list(batch.read_pairs(file, args.format))
+
+  results = run(args, pairs)
+  print(json.dumps(results, indent=2))
+
+  f1 = results['agreement']['f1']
+  print(f'{results["speedup"]:.2f}x faster, F1 {f1:.3f} against fp32, {results["agreement"]["identical"]:.1%} of pairs identical', file=sys.stderr)
+  if f1 < args.min_agreement:
+    print(f'Agreement is below {args.min_agreement}', file=sys.stderr)
+    sys.exit(1)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+'''
+Aligns whole paragraphs or documents.
+
+align.py asks a question for every token in `from_text` with all of `to_text`
+as the context, so on long inputs every question pays for attention over the
+whole document, and contexts longer than the model's max sequence length are
+split into overlapping windows which are each run through the model. Here both
+sides are split into sentences, and each "from" sentence is aligned, as the
+question, against only a window of "to" sentences around the same point in the
+document, so the cost per token depends on the length of the sentences rather
+than of the document.
+
+Sentences are paired by their position: the middle of a "from" sentence, as a
+fraction of the length of `from_text`, is mapped to the same fraction of
+`to_text`, and the window is the sentence there along with `window` sentences
+on either side. This assumes that the translation keeps the sentences in
+roughly the same order, which the window allows some leeway for.
+
+The results are mapped back to character offsets in the whole texts, in the
+same flat format as align.py, and simplified together.
+
+  ./document.py --from-language ja --from-file ja.txt --to-language en --to-file en.txt
+'''
+import argparse
+import bisect
+import re
+import sys
+import numpy as np
+from align import DEFAULT_BATCH_SIZE, DEFAULT_THRESHOLD, TOKENIZER_LOCKS, TOKENIZERS, align_many, get_tokenizer
+from scored import SYMMETRIC_MODES
+from simplify import simplify, SIMPLIFY_MODES
+import profiling
+import simplify_exact
+
+# Number of "to" sentences on either side of the one at the same position as
+# the "from" sentence that are included in its context.
+DEFAULT_WINDOW = 1
+
+# Longest piece of text in UTF-8 bytes that's tokenized at once; SudachiPy,
+# used for Japanese, rejects input over 49149 bytes.
+MAX_TOKENIZE_BYTES = 32768
+
+# Characters after which a line too long to tokenize at once is preferably cut.
+BREAK_AFTER = '。．！？.!? \t'
+
+_sentencizer = None
+
+def get_chunks(text: str, max_bytes: int = MAX_TOKENIZE_BYTES) -> list[tuple[int, int]]:
+  '''
+  Returns the (start, end) of consecutive pieces of the text of at most
+  `max_bytes` in UTF-8, made of whole lines where possible. Longer lines are cut
+  after the last sentence end or space that leaves at least half of the piece.
+  '''
+  chunks: list[tuple[int, int]] = []
+  (start, size) = (0, 0)
+  for line in re.finditer(r'[^\n]*\n?', text):
+    line_size = len(line.group().encode('utf-8'))
+    if size + line_size > max_bytes and size > 0:
+      chunks.append((start, line.start()))
+      (start, size) = (line.start(), 0)
+
+    if line_size <= max_bytes:
+      size += line_size
+      continue
+
+    # Every character is at most 4 bytes
+    (line_start, line_end) = line.span()
+    length = max_bytes // 4
+    while line_end - line_start > length:
+      piece = text[line_start:line_start + length]
+      cut = max(piece.rfind(c) for c in BREAK_AFTER) + 1
+      if cut < length // 2:
+        cut = length
+      chunks.append((line_start, line_start + cut))
+      line_start += cut
+    (start, size) = (line_start, len(text[line_start:line_end].encode('utf-8')))
+
+  if start < len(text):
+    chunks.append((start, len(text)))
+  return chunks
+
+def get_sentence_ranges(language: str, text: str) -> list[tuple[int, int]]:
+  '''
+  Splits the text into sentences with spaCy's rule-based sentencizer, and at
+  line breaks, and returns the (start, end) of each without surrounding
+  whitespace. Long texts are tokenized in chunks of whole lines (see
+  `get_chunks`), which doesn't change the sentences since they're split at
+  line breaks anyway.
+  '''
+  global _sentencizer
+  if _sentencizer is None:
+    from spacy.pipeline import Sentencizer
+    _sentencizer = Sentencizer()
+
+  tokenizer = get_tokenizer(language)
+  sentences: list[tuple[int, int]] = []
+  with profiling.stage('sentencize'):
+    for (chunk_start, chunk_end) in get_chunks(text):
+      with TOKENIZER_LOCKS[language]:
+        doc = tokenizer(text[chunk_start:chunk_end])
+      sentences.extend((chunk_start + s.start_char, chunk_start + s.end_char) for s in _sentencizer(doc).sents)
+
+  result: list[tuple[int, int]] = []
+  for (start, end) in sentences:
+    for line in re.finditer(r'[^\n]+', text[start:end]):
+      line_start = start + line.start() + len(line.group()) - len(line.group().lstrip())
+      line_end = start + line.start() + len(line.group().rstrip())
+      if line_start < line_end:
+        result.append((line_start, line_end))
+  return result
+
+def get_windows(
+  from_sentences: list[tuple[int, int]],
+  from_length: int,
+  to_sentences: list[tuple[int, int]],
+  to_length: int,
+  window: int = DEFAULT_WINDOW) -> list[tuple[int, int]]:
+  '''
+  Returns the (start, end) in the "to" text of the context for each "from"
+  sentence: the sentences around the same relative position.
+  '''
+  to_ends = [end for (_, end) in to_sentences]
+  result: list[tuple[int, int]] = []
+
+  for (start, end) in from_sentences:
+    position = (start + end) / 2 / from_length * to_length
+    center = min(bisect.bisect_left(to_ends, position), len(to_sentences) - 1)
+    first = max(center - window, 0)
+    last = min(center + window, len(to_sentences) - 1)
+    result.append((to_sentences[first][0], to_sentences[last][1]))
+
+  return result
+
+def align(
+  from_language: str,
+  from_text: str,
+  to_language: str,
+  to_text: str,
+  threshold: float = DEFAULT_THRESHOLD,
+  symmetric: bool = False,
+  symmetric_mode: str = 'AND',
+  simplify_result: bool = True,
+  batch_size: int = DEFAULT_BATCH_SIZE,
+  simplify_mode: str = 'greedy',
+  window: int = DEFAULT_WINDOW,
+  quantized: bool = False) -> list[int]:
+  '''
+  Same as align.align, for texts of any length. The questions for every
+  sentence are packed into the same inference batches.
+  '''
+  from_sentences = get_sentence_ranges(from_language, from_text)
+  to_sentences = get_sentence_ranges(to_language, to_text)
+  if not from_sentences or not to_sentences:
+    return []
+
+  windows = get_windows(from_sentences, len(from_text), to_sentences, len(to_text), window)
+  pairs = [
+    (from_text[from_start:from_end], to_text[to_start:to_end])
+    for ((from_start, from_end), (to_start, to_end)) in zip(from_sentences, windows)
+  ]
+
+  results = align_many(
+    from_language,
+    to_language,
+    pairs,
+    threshold,
+    symmetric,
+    symmetric_mode,
+    False,
+    batch_size,
+    quantized=quantized)
+
+  # Offset each sentence's alignments by where the sentence and its window
+  # start in the whole texts
+  ranges = [
+    np.array(result, dtype=np.int64).reshape(-1, 4) + [from_start, from_start, to_start, to_start]
+    for (result, (from_start, _), (to_start, _)) in zip(results, from_sentences, windows)
+  ]
+  result = np.concatenate(ranges).reshape(-1).tolist()
+  return simplify(result, from_text, to_text, simplify_mode) if simplify_result else result
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--from-language', type=str, required=True, choices=TOKENIZERS.keys())
+  parser.add_argument('--from-file', type=str, required=True)
+  parser.add_argument('--to-language', type=str, required=True, choices=TOKENIZERS.keys())
+  parser.add_argument('--to-file', type=str, required=True)
+  parser.add_argument('--window', type=int, default=DEFAULT_WINDOW, help='Number of sentences either side included in the context')
+  parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD)
+  parser.add_argument('--symmetric', action='store_true', default=False)
+  parser.add_argument('--symmetric-mode', type=str, default='AND', choices=SYMMETRIC_MODES)
+  parser.add_argument('--no-simplify', action='store_true', default=False)
+  parser.add_argument('--simplify-mode', type=str, default='greedy', choices=SIMPLIFY_MODES)
+  parser.add_argument('--simplify-time-budget', type=float, default=simplify_exact.DEFAULT_TIME_BUDGET, help='Seconds the exact simplify mode searches for each pair before using the best result so far')
+  parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE)
+  parser.add_argument('--quantized', action='store_true', default=False, help='Use dynamic int8 quantization (faster on CPU, see compare_quantized.py)')
+  parser.add_argument('--profile', action='store_true', default=False, help='Print the time spent in each stage to stderr')
+  args = parser.parse_args()
+  profiling.enabled = args.profile
+  simplify_exact.current_time_budget = args.simplify_time_budget
+
+  with open(args.from_file, encoding='utf-8') as file:
+    from_text = file.read()
+  with open(args.to_file, encoding='utf-8') as file:
+    to_text = file.read()
+
+  result = align(
+    args.from_language,
+    from_text,
+    args.to_language,
+    to_text,
+    args.threshold,
+    args.symmetric,
+    args.symmetric_mode,
+    not args.no_simplify,
+    args.batch_size,
+    args.simplify_mode,
+    args.window,
+    args.quantized)
+
+  print(','.join(str(i) for i in result))
+
+  if args.profile:
+    print(profiling.summary(), file=sys.stderr)
@@ -0,0 +1,227 @@
+'''
+Process-wide registry of loaded models.
+
+Constructing a model reads its weights from disk and builds it from scratch,
+which on CPU takes longer than running it. The registry loads each model once,
+either on first use or eagerly via `preload`, keeps it warm for the lifetime of
+the process, and evicts the least recently used one when more than `max_models`
+are in memory.
+
+Models are identified by a "kind", which selects the loader, and a name or path
+passed to that loader, e.g. ('wsp', 'qiyuw/WSPAlign-ft-kftt'). Each kind has an
+"-int8" variant, which loads the same model with its Linear layers converted to
+dynamic int8 quantization: weights are stored as int8 and activations are
+quantized on the fly, which is faster on CPU at some cost in accuracy (see
+compare_quantized.py).
+
+When MODEL_SNAPSHOTS is set, models that have a snapshot there (see
+snapshot.py) are loaded from it, memory-mapped, so that every process using the
+model shares the same pages.
+'''
+import os
+import sys
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from threading import Lock
+from typing import Any, Callable, NamedTuple
+import profiling
+
+# Number of models kept in memory before the least recently used is evicted.
+DEFAULT_MAX_MODELS = int(os.environ.get('MAX_MODELS', 4))
+
+# The awesome-align submodule, which isn't an installable package.
+AWESOME_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'awesome-align')
+
+# Where awesome-align downloads models given by name, e.g. mBERT.
+AWESOME_CACHE_DIR = './models/bert'
+
+class AwesomeModel(NamedTuple):
+  model: Any
+  tokenizer: Any
+
+def load_qa_pipeline(name: str) -> Any:
+  '''Loads a question-answering model such as WSPAlign.'''
+  import snapshot
+  from transformers import pipeline
+
+  if (path := snapshot.find('wsp', name)) is not None:
+    from transformers import AutoConfig, AutoModelForQuestionAnswering, AutoTokenizer
+    config = AutoConfig.from_pretrained(path)
+    model = snapshot.load_weights(lambda: AutoModelForQuestionAnswering.from_config(config), path)
+    return pipeline('question-answering', model=model, tokenizer=AutoTokenizer.from_pretrained(path))
+
+  return pipeline('question-answering', model=name)
+
+def load_awesome_model(name: str) -> AwesomeModel:
+  '''Loads a model and tokenizer the same way as awesome_align.run_align.'''
+  import snapshot
+  if AWESOME_PATH not in sys.path:
+    sys.path.append(AWESOME_PATH)
+  from awesome_align import modeling
+  from awesome_align.configuration_bert import BertConfig
+  from awesome_align.modeling import BertForMaskedLM
+  from awesome_align.tokenization_bert import BertTokenizer
+
+  snapshot_path = snapshot.find('awesome', name)
+  config = BertConfig.from_pretrained(snapshot_path or name, cache_dir=AWESOME_CACHE_DIR)
+  tokenizer = BertTokenizer.from_pretrained(snapshot_path or name, cache_dir=AWESOME_CACHE_DIR)
+
+  # awesome-align reads these from module globals rather than the tokenizer
+  modeling.PAD_ID = tokenizer.pad_token_id
+  modeling.CLS_ID = tokenizer.cls_token_id
+  modeling.SEP_ID = tokenizer.sep_token_id
+
+  if snapshot_path is not None:
+    model = snapshot.load_weights(lambda: BertForMaskedLM(config), snapshot_path)
+  else:
+    model = BertForMaskedLM.from_pretrained(name, config=config, cache_dir=AWESOME_CACHE_DIR)
+  model.eval()
+  return AwesomeModel(model, tokenizer)
+
+def quantize(model: Any) -> Any:
+  '''Returns a copy of the model with dynamic int8 quantization of its Linear layers.'''
+  import torch
+  return torch.ao.quantization.quantize_dynamic(model, { torch.nn.Linear }, dtype=torch.qint8)
+
+def load_quantized_qa_pipeline(name: str) -> Any:
+  pipe = load_qa_pipeline(name)
+  pipe.model = quantize(pipe.model)
+  return pipe
+
+def load_quantized_awesome_model(name: str) -> AwesomeModel:
+  (model, tokenizer) = load_awesome_model(name)
+  return AwesomeModel(quantize(model), tokenizer)
+
+LOADERS: dict[str, Callable[[str], Any]] = {
+  'wsp': load_qa_pipeline,
+  'wsp-int8': load_quantized_qa_pipeline,
+  'awesome': load_awesome_model,
+  'awesome-int8': load_quantized_awesome_model,
+}
+
+def get_kind(kind: str, quantized: bool) -> str:
+  '''Returns the kind of the int8 variant of the model if `quantized`.'''
+  return f'{kind}-int8' if quantized else kind
+
+@dataclass
+class LoadedModel:
+  kind: str
+  name: str
+  value: Any
+  load_time: float
+  memory: int
+
+def get_memory_footprint(value: Any) -> int:
+  '''Returns the size in bytes of the parameters and buffers of the model.'''
+  model = getattr(value, 'model', value)
+  if hasattr(model, 'get_memory_footprint'):
+    size = model.get_memory_footprint()
+  elif hasattr(model, 'parameters'):
+    size = sum(t.numel() * t.element_size() for t in [*model.parameters(), *model.buffers()])
+  else:
+    return 0
+
+  # Quantized Linear layers keep their int8 weights in packed params rather
+  # than parameters
+  for module in model.modules():
+    if type(module).__name__ == 'LinearPackedParams':
+      size += sum(t.numel() * t.element_size() for t in module._weight_bias() if t is not None)
+  return size
+
+def get_unique_memory() -> int | None:
+  '''
+  Returns the unique set size of this process in bytes: the memory that isn't
+  shared with any other process, such as memory-mapped model weights that
+  another process has also loaded. None if it can't be read (Linux only).
+  '''
+  try:
+    with open('/proc/self/smaps_rollup') as file:
+      lines = file.read().splitlines()
+  except OSError:
+    return None
+
+  size = 0
+  for line in lines:
+    (field, _, value) = line.partition(':')
+    if field in ('Private_Clean', 'Private_Dirty'):
+      size += int(value.split()[0]) * 1024
+  return size
+
+class ModelRegistry:
+  def __init__(self, max_models: int = DEFAULT_MAX_MODELS):
+    self.max_models = max_models
+    self._models: OrderedDict[tuple[str, str], LoadedModel] = OrderedDict()
+    self._lock = Lock()
+    self._load_locks: dict[tuple[str, str], Lock] = {}
+
+  def _get_loaded(self, key: tuple[str, str]) -> LoadedModel | None:
+    with self._lock:
+      if key in self._models:
+        self._models.move_to_end(key)
+        return self._models[key]
+      return None
+
+  def get(self, kind: str, name: str) -> Any:
+    '''Returns the model, loading it first if it isn't already in memory.'''
+    key = (kind, name)
+    if (loaded := self._get_loaded(key)) is not None:
+      return loaded.value
+
+    # Loading under a lock per model means concurrent requests for a cold model
+    # wait for the one load rather than each constructing their own copy, while
+    # requests for models that are already loaded don't wait at all
+    with self._lock:
+      load_lock = self._load_locks.setdefault(key, Lock())
+
+    with load_lock:
+      if (loaded := self._get_loaded(key)) is not None:
+        return loaded.value
+
+      start = time.perf_counter()
+      with profiling.stage('load_model'):
+        value = LOADERS[kind](name)
+      load_time = time.perf_counter() - start
+      memory = get_memory_footprint(value)
+
+      with self._lock:
+        self._models[key] = LoadedModel(kind, name, value, load_time, memory)
+        while len(self._models) > self.max_models:
+          (evicted_kind, evicted_name), _ = self._models.popitem(last=False)
+          print(f'Evicted {evicted_kind} model {evicted_name}', file=sys.stderr)
+
+      print(f'Loaded {kind} model {name} in {load_time:.2f}s', file=sys.stderr)
+      return value
+
+  def preload(self, specs: list[str]):
+    '''Loads models given as "kind:name" strings, e.g. from an env var.'''
+    for spec in specs:
+      kind, name = spec.strip().split(':', 1)
+      self.get(kind, name)
+
+  def evict(self, kind: str, name: str) -> bool:
+    with self._lock:
+      return self._models.pop((kind, name), None) is not None
+
+  def clear(self):
+    with self._lock:
+      self._models.clear()
+
+  def stats(self) -> list[dict[str, Any]]:
+    '''Returns the load time (seconds) and memory footprint (bytes) of each model.'''
+    with self._lock:
+      return [
+        { 'kind': m.kind, 'name': m.name, 'loadTime': m.load_time, 'memory': m.memory }
+        for m in self._models.values()
+      ]
+
+registry = ModelRegistry()
+
+def get(kind: str, name: str) -> Any:
+  return registry.get(kind, name)
+
+def preload(specs: list[str]):
+  registry.preload(specs)
+
+def stats() -> list[dict[str, Any]]:
+  return registry.stats()
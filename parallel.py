@@ -0,0 +1,198 @@
+'''
+Splits a corpus across a pool of worker processes.
+
+Each worker loads its own copy of the model and runs with a fixed number of
+torch intra-op threads so that the workers together use every core without
+oversubscribing them. Chunks of pairs are handed out as workers become free,
+but results are written strictly in input order. If a worker process dies (for
+example killed by the OOM killer), the pool is restarted and every chunk that
+hadn't been written yet is submitted again, so no pairs are lost. Only the
+chunks that were running when it died count towards their retry limit.
+
+Workers call the same `align_many` functions as the single-process path in
+batch.py, so the output is identical.
+
+Each worker loads the model as it starts, so its own copy of the weights adds
+to the memory use of every worker. To avoid that, either load the models from
+memory-mapped snapshots (see snapshot.py), which the workers share through the
+page cache, or use --fork to load the model once in this process and fork the
+workers from it, which also shares quantized models. The time each worker took
+to start up and load the model, and its unique memory (that isn't shared with
+other processes), are printed at the end.
+'''
+import argparse
+import itertools
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import TextIO
+import align
+import batch
+import binary
+import models
+import profiling
+import simplify_exact
+
+# Number of times a chunk is resubmitted after the pool crashes before giving
+# up.
+MAX_RETRIES = 3
+
+# Seconds from the worker process starting until its model was loaded.
+cold_start = 0.0
+
+def get_model_specs(args: argparse.Namespace) -> list[str]:
+  '''Returns the model used by the workers as "kind:name" for models.preload.'''
+  if args.method == 'awesome':
+    # The subprocess backend loads the model in a new process for every chunk
+    return [f'{models.get_kind("awesome", args.quantized)}:{args.model}'] if args.backend == 'inprocess' else []
+  # Read when called rather than imported, in case it was set after import
+  return [f'{models.get_kind("wsp", args.quantized)}:{align.MODEL}']
+
+def get_process_age() -> float | None:
+  '''Returns the seconds since this process started, or None if unknown (Linux only).'''
+  try:
+    with open('/proc/self/stat') as file:
+      start_ticks = int(file.read().rsplit(')', 1)[1].split()[19])
+    with open('/proc/uptime') as file:
+      uptime = float(file.read().split()[0])
+  except OSError:
+    return None
+  return uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+
+def init_worker(threads: int, profile: bool, specs: list[str], time_budget: float, wsp_model: str):
+  global cold_start
+  start = time.perf_counter()
+  import torch
+  torch.set_num_threads(threads)
+  profiling.enabled = profile
+  simplify_exact.current_time_budget = time_budget
+  # Spawned workers import align afresh, so they'd otherwise use its default
+  align.MODEL = wsp_model
+
+  # Already loaded if the worker was forked after loading it
+  models.preload(specs)
+  age = get_process_age()
+  cold_start = age if age is not None else time.perf_counter() - start
+
+def align_chunk(args: argparse.Namespace, pairs: list[tuple[str, str]]) -> tuple[list[tuple[list[int], list[float] | None]], int, float, float, int | None, profiling.Recorder]:
+  start = time.perf_counter()
+  results = batch.align_chunk(args, pairs)
+  # The worker's stage timings are sent back with each chunk to be merged
+  return results, os.getpid(), time.perf_counter() - start, cold_start, models.get_unique_memory(), profiling.recorder.take()
+
+def create_pool(workers: int, threads: int, fork: bool, specs: list[str]) -> ProcessPoolExecutor:
+  # Forking a process that has already started torch's thread pools can
+  # deadlock, so workers are spawned fresh unless this process has only
+  # loaded the model, on a single thread (see run)
+  return ProcessPoolExecutor(
+    max_workers=workers,
+    mp_context=multiprocessing.get_context('fork' if fork else 'spawn'),
+    initializer=init_worker,
+    initargs=(threads, profiling.enabled, specs, simplify_exact.current_time_budget, align.MODEL))
+
+def run(args: argparse.Namespace, input_file: TextIO, writer: batch.TextWriter | binary.Writer, skip: int):
+  workers: int = args.workers
+  threads: int = args.threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+  print(f'Starting {workers} workers with {threads} threads each', file=sys.stderr)
+  start_time = time.perf_counter()
+
+  specs = get_model_specs(args)
+  if args.fork:
+    # The forked workers share the pages of the loaded model with this process
+    # for as long as neither writes to them. Loading on one thread keeps torch
+    # from starting a thread pool that wouldn't survive the fork.
+    import torch
+    torch.set_num_threads(1)
+    models.preload(specs)
+
+  pairs = itertools.islice(batch.read_pairs(input_file, args.format), skip, None)
+  chunks = enumerate(batch.chunked(pairs, args.chunk_size))
+
+  pending: dict[int, list[tuple[str, str]]] = {}  # Chunks not yet written
+  running: dict[Future, int] = {}
+  finished: dict[int, list[tuple[list[int], list[float] | None]]] = {}
+  retries: dict[int, int] = {}
+  worker_stats: dict[int, tuple[int, float, float, int | None]] = {}  # pid -> (pairs, seconds, cold start, unique memory)
+  next_to_write = 0
+  next_to_read = 0
+  done = skip
+  pool = create_pool(workers, threads, args.fork, specs)
+
+  def submit(index: int):
+    running[pool.submit(align_chunk, args, pending[index])] = index
+
+  try:
+    while True:
+      # Keep every worker busy plus one chunk queued for each, without reading
+      # more of the input than that. The limit is on how far ahead of the next
+      # chunk to write they are, so that a slow chunk doesn't leave an unbounded
+      # number of later ones waiting in memory to be written.
+      while next_to_read < next_to_write + workers * 2:
+        next_chunk = next(chunks, None)
+        if next_chunk is None:
+          break
+        index, chunk = next_chunk
+        pending[index] = chunk
+        submit(index)
+        next_to_read += 1
+
+      if not running:
+        break
+
+      completed, _ = wait(running, return_when=FIRST_COMPLETED)
+      crashed = False
+
+      for future in completed:
+        index = running.pop(future)
+        try:
+          results, pid, elapsed, worker_cold_start, memory, worker_metrics = future.result()
+        except BrokenProcessPool:
+          crashed = True
+          continue
+
+        finished[index] = results
+        profiling.recorder.merge(worker_metrics)
+        pairs_done, seconds, _, _ = worker_stats.get(pid, (0, 0.0, 0.0, None))
+        worker_stats[pid] = (pairs_done + len(results), seconds + elapsed, worker_cold_start, memory)
+
+      if crashed:
+        # Every chunk still in the pool is lost with it; resubmit them all to a
+        # fresh pool. The pool runs them in the order they were submitted, which
+        # is by index, so only the first one for each worker could have been
+        # running when it crashed. The rest were queued and aren't to blame.
+        lost = sorted(i for i in pending if i not in finished)
+        print(f'Worker crashed; restarting pool and resubmitting {len(lost)} chunks', file=sys.stderr)
+        for index in lost[:workers]:
+          retries[index] = retries.get(index, 0) + 1
+          if retries[index] > MAX_RETRIES:
+            raise RuntimeError(f'Chunk {index} failed after {MAX_RETRIES} retries')
+
+        pool.shutdown(wait=False, cancel_futures=True)
+        pool = create_pool(workers, threads, args.fork, specs)
+        running.clear()
+        for index in lost:
+          submit(index)
+
+      while next_to_write in finished:
+        for (result, scores) in finished.pop(next_to_write):
+          writer.write(result, scores)
+        writer.flush()
+
+        done += len(pending.pop(next_to_write))
+        next_to_write += 1
+        print(f'Aligned {done} pairs', file=sys.stderr)
+  finally:
+    pool.shutdown(cancel_futures=True)
+
+  print_stats(worker_stats, done - skip, time.perf_counter() - start_time)
+
+def print_stats(worker_stats: dict[int, tuple[int, float, float, int | None]], total_pairs: int, total_seconds: float):
+  for pid, (pairs, seconds, startup, memory) in sorted(worker_stats.items()):
+    print(f'  Worker {pid}: {pairs} pairs in {seconds:.1f}s ({pairs / seconds:.2f} pairs/s)', file=sys.stderr)
+    memory_text = f', {memory / 2**20:.0f} MiB unique memory' if memory is not None else ''
+    print(f'    started in {startup:.2f}s{memory_text}', file=sys.stderr)
+  if total_seconds > 0:
+    print(f'  Total: {total_pairs} pairs in {total_seconds:.1f}s ({total_pairs / total_seconds:.2f} pairs/s)', file=sys.stderr)
@@ -0,0 +1,182 @@
+'''
+Lightweight per-stage timing of the alignment hot path.
+
+Code that does a significant amount of work wraps it in a stage:
+
+  with profiling.stage('tokenize'):
+    ...
+  profiling.count('tokens', len(tokens))
+
+which records how long it took in a histogram, and counters for things like
+the number of tokens or questions processed, when `enabled` is set (by
+--profile on the CLIs, or by visualize.py). Otherwise `stage` returns a shared
+no-op context manager and `count` returns immediately, so the instrumentation
+costs a function call and an attribute check.
+
+The results can be printed as a summary table, or exported in the Prometheus
+text format for visualize.py's /metrics endpoint.
+'''
+import bisect
+import time
+from threading import Lock
+from typing import Any
+
+# Upper bounds of the latency histogram buckets, in seconds.
+DEFAULT_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+
+enabled = False
+
+class Histogram:
+  def __init__(self, buckets: list[float] = DEFAULT_BUCKETS):
+    self.buckets = buckets
+    self.counts = [0] * (len(buckets) + 1)  # The last is +Inf
+    self.sum = 0.0
+    self.count = 0
+
+  def observe(self, value: float):
+    self.counts[bisect.bisect_left(self.buckets, value)] += 1
+    self.sum += value
+    self.count += 1
+
+  def merge(self, other: 'Histogram'):
+    for i, count in enumerate(other.counts):
+      self.counts[i] += count
+    self.sum += other.sum
+    self.count += other.count
+
+class Recorder:
+  '''Thread-safe store of histograms and counters, keyed by name and label.'''
+
+  def __init__(self):
+    self.histograms: dict[tuple[str, str], Histogram] = {}
+    self.counters: dict[str, int] = {}
+    self._lock = Lock()
+
+  def observe(self, metric: str, label: str, value: float):
+    with self._lock:
+      histogram = self.histograms.get((metric, label))
+      if histogram is None:
+        histogram = self.histograms[(metric, label)] = Histogram()
+      histogram.observe(value)
+
+  def count(self, name: str, value: int):
+    with self._lock:
+      self.counters[name] = self.counters.get(name, 0) + value
+
+  def merge(self, other: 'Recorder'):
+    '''Adds the metrics recorded by another recorder, e.g. from a worker process.'''
+    with self._lock:
+      for key, histogram in other.histograms.items():
+        self.histograms.setdefault(key, Histogram(histogram.buckets)).merge(histogram)
+      for name, value in other.counters.items():
+        self.counters[name] = self.counters.get(name, 0) + value
+
+  def take(self) -> 'Recorder':
+    '''Returns a copy of the metrics recorded so far and resets them.'''
+    with self._lock:
+      result = Recorder()
+      result.histograms, self.histograms = self.histograms, {}
+      result.counters, self.counters = self.counters, {}
+      return result
+
+  def clear(self):
+    with self._lock:
+      self.histograms.clear()
+      self.counters.clear()
+
+  def __getstate__(self) -> dict[str, Any]:
+    return { 'histograms': self.histograms, 'counters': self.counters }
+
+  def __setstate__(self, state: dict[str, Any]):
+    self.__init__()
+    self.histograms = state['histograms']
+    self.counters = state['counters']
+
+  def summary(self) -> str:
+    '''Formats the stage timings and counters as a table.'''
+    with self._lock:
+      stages = sorted(
+        ((label, h) for ((metric, label), h) in self.histograms.items() if metric == 'stage'),
+        key=lambda x: -x[1].sum)
+      lines = [f'{"Stage":<24} {"Calls":>8} {"Total (s)":>10} {"Mean (ms)":>10}']
+      for label, h in stages:
+        lines.append(f'{label:<24} {h.count:>8} {h.sum:>10.3f} {h.sum / h.count * 1000:>10.3f}')
+      for name, value in sorted(self.counters.items()):
+        lines.append(f'{name:<24} {value:>8}')
+      return '\n'.join(lines)
+
+  def to_prometheus(self, prefix: str = 'alignment') -> str:
+    '''Formats the metrics in the Prometheus text exposition format.'''
+    lines: list[str] = []
+    with self._lock:
+      for metric in sorted({ metric for (metric, _) in self.histograms }):
+        name = f'{prefix}_{metric}_seconds'
+        lines.append(f'# TYPE {name} histogram')
+        label_name = 'stage' if metric == 'stage' else 'method'
+        for (m, label), h in sorted(self.histograms.items()):
+          if m != metric:
+            continue
+          label = escape_label(label)
+          cumulative = 0
+          for bound, count in zip([*h.buckets, '+Inf'], h.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+          lines.append(f'{name}_sum{{{label_name}="{label}"}} {h.sum}')
+          lines.append(f'{name}_count{{{label_name}="{label}"}} {h.count}')
+
+      for counter, value in sorted(self.counters.items()):
+        name = f'{prefix}_{counter}_total'
+        lines.append(f'# TYPE {name} counter')
+        lines.append(f'{name} {value}')
+
+    return '\n'.join(lines) + '\n'
+
+def escape_label(value: str) -> str:
+  '''Escapes a label value for the Prometheus text format, which may come from a request.'''
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+class Stage:
+  __slots__ = ('name', 'start')
+
+  def __init__(self, name: str):
+    self.name = name
+
+  def __enter__(self):
+    self.start = time.perf_counter()
+    return self
+
+  def __exit__(self, *exc_info):
+    recorder.observe('stage', self.name, time.perf_counter() - self.start)
+
+class NullStage:
+  __slots__ = ()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    pass
+
+NULL_STAGE = NullStage()
+
+recorder = Recorder()
+
+def stage(name: str) -> Stage | NullStage:
+  '''Times the enclosed block as the named stage, if profiling is enabled.'''
+  return Stage(name) if enabled else NULL_STAGE
+
+def count(name: str, value: int):
+  '''Adds to the named counter, if profiling is enabled.'''
+  if enabled:
+    recorder.count(name, value)
+
+def observe(metric: str, label: str, value: float):
+  '''Records a duration in seconds in a histogram other than the stage timings.'''
+  if enabled:
+    recorder.observe(metric, label, value)
+
+def summary() -> str:
+  return recorder.summary()
+
+def to_prometheus() -> str:
+  return recorder.to_prometheus()
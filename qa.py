@@ -0,0 +1,170 @@
+'''
+Batched question-answering inference.
+
+Produces the same predictions as calling a transformers question-answering
+pipeline once per question, but tokenizes every question in a single call, runs
+the model over padded batches, and decodes the answer spans for a whole batch at
+once with NumPy. The decoding mirrors the pipeline's postprocessing (softmax
+over the context tokens, best span of at most `MAX_ANSWER_LEN` tokens, expanded
+to whole words) so results are interchangeable with `pipe(question, context)`.
+
+Only models whose tokenizer puts the question first (right padding), which
+includes all of the BERT-based models used here, are supported.
+'''
+from typing import Any
+import numpy as np
+import profiling
+
+# Number of question/context features run through the model at once.
+DEFAULT_BATCH_SIZE = 32
+
+# Same defaults as the question-answering pipeline.
+MAX_ANSWER_LEN = 15
+MAX_SEQ_LEN = 384
+
+def predict(
+  pipe: Any,
+  questions: list[str],
+  contexts: list[str],
+  batch_size: int = DEFAULT_BATCH_SIZE) -> list[dict[str, Any] | None]:
+  '''
+  Returns the best answer ({score, start, end, answer}) in the corresponding
+  context for each question, or None if the model didn't find one.
+  '''
+  assert len(questions) == len(contexts)
+  if len(questions) == 0:
+    return []
+
+  # Imported here, as importing torch takes a second or more
+  import torch
+
+  model = pipe.model
+  tokenizer = pipe.tokenizer
+  assert tokenizer.padding_side == 'right'
+
+  # Long contexts are split into overlapping windows the same way the pipeline
+  # does it; each window becomes a separate feature mapped back to its question
+  max_seq_len = min(tokenizer.model_max_length, MAX_SEQ_LEN)
+  with profiling.stage('qa_tokenize'):
+    encoded = tokenizer(
+      questions,
+      contexts,
+      truncation='only_second',
+      max_length=max_seq_len,
+      stride=min(max_seq_len // 2, 128),
+      return_token_type_ids=True,
+      return_overflowing_tokens=True,
+      return_offsets_mapping=True)
+  feature_questions: list[int] = encoded['overflow_to_sample_mapping']
+  model_input_names = tokenizer.model_input_names
+
+  # Sorting by length keeps padding within each batch to a minimum
+  order = sorted(range(len(feature_questions)), key=lambda i: len(encoded['input_ids'][i]))
+  best: list[dict[str, Any] | None] = [None] * len(questions)
+
+  for batch_start in range(0, len(order), batch_size):
+    features = order[batch_start:batch_start + batch_size]
+    batch = pad({ k: [encoded[k][i] for i in features] for k in model_input_names }, {
+      'input_ids': tokenizer.pad_token_id,
+      'token_type_ids': tokenizer.pad_token_type_id,
+    })
+
+    with profiling.stage('qa_forward'), torch.inference_mode():
+      output = model(**{ k: torch.from_numpy(v) for k, v in batch.items() })
+    profiling.count('features', len(features))
+
+    with profiling.stage('qa_decode'):
+      # Only context tokens (sequence id 1) and [CLS] may be part of the answer
+      attention_mask = batch['attention_mask'].astype(bool)
+      desired = np.zeros_like(attention_mask)
+      for row, i in enumerate(features):
+        length = len(encoded['input_ids'][i])
+        desired[row, :length] = [s == 1 for s in encoded.sequence_ids(i)]
+        desired[row, :length] |= np.array(encoded['input_ids'][i]) == tokenizer.cls_token_id
+      desired &= attention_mask
+
+      starts, ends, scores = decode_spans(
+        output.start_logits.float().numpy(),
+        output.end_logits.float().numpy(),
+        desired)
+
+      for row, i in enumerate(features):
+        if starts[row] < 0:
+          continue
+        question = feature_questions[i]
+
+        # Windows are compared by score; the first one wins a tie like the stable
+        # sort in the pipeline (features are processed out of order here)
+        current = best[question]
+        if current is not None and (scores[row] < current['score'] or \
+           (scores[row] == current['score'] and current['feature'] < i)):
+          continue
+
+        start, end = get_char_indices(encoded.encodings[i], starts[row], ends[row])
+        best[question] = {
+          'score': float(scores[row]),
+          'start': start,
+          'end': end,
+          'answer': contexts[question][start:end],
+          'feature': i,
+        }
+
+  for prediction in best:
+    if prediction is not None:
+      del prediction['feature']
+
+  return best
+
+def pad(inputs: dict[str, list[list[int]]], pad_values: dict[str, int]) -> dict[str, np.ndarray]:
+  '''Right-pads each model input to the longest sequence in the batch.'''
+  result: dict[str, np.ndarray] = {}
+  for name, sequences in inputs.items():
+    padded = np.full((len(sequences), max(len(x) for x in sequences)), pad_values.get(name, 0), dtype=np.int64)
+    for row, sequence in enumerate(sequences):
+      padded[row, :len(sequence)] = sequence
+    result[name] = padded
+  return result
+
+def decode_spans(start_logits: np.ndarray, end_logits: np.ndarray, desired: np.ndarray) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''
+  Finds the most probable answer span in each row. Returns arrays of start and
+  end token indexes (-1 if the best span isn't in the context) and scores.
+  '''
+  start = softmax(np.where(desired, start_logits, -10000.0))
+  end = softmax(np.where(desired, end_logits, -10000.0))
+
+  # The pipeline doesn't allow [CLS] as an answer unless handle_impossible_answer
+  start[:, 0] = end[:, 0] = 0.0
+
+  # Score every (start, end) pair, removing those where end < start or the span
+  # is longer than MAX_ANSWER_LEN
+  outer = np.matmul(start[:, :, None], end[:, None, :])
+  candidates = np.tril(np.triu(outer), MAX_ANSWER_LEN - 1)
+
+  rows = np.arange(len(candidates))
+  best = candidates.reshape(len(candidates), -1).argmax(axis=1)
+  starts, ends = np.unravel_index(best, candidates.shape[1:])
+  scores = candidates[rows, starts, ends]
+
+  is_desired = desired[rows, starts] & desired[rows, ends]
+  starts = np.where(is_desired, starts, -1)
+  ends = np.where(is_desired, ends, -1)
+  return starts, ends, scores
+
+def softmax(logits: np.ndarray) -> np.ndarray:
+  x = np.exp(logits - logits.max(axis=-1, keepdims=True))
+  return x / x.sum(axis=-1, keepdims=True)
+
+def get_char_indices(encoding: Any, start_token: int, end_token: int) -> tuple[int, int]:
+  '''
+  Converts a token span to a character span in the context, expanded to whole
+  words since the best tokens are sometimes in the middle of one.
+  '''
+  try:
+    start_word = encoding.token_to_word(start_token)
+    end_word = encoding.token_to_word(end_token)
+    return (
+      encoding.word_to_chars(start_word, sequence_index=1)[0],
+      encoding.word_to_chars(end_word, sequence_index=1)[1])
+  except Exception:
+    return (encoding.offsets[start_token][0], encoding.offsets[end_token][1])
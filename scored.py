@@ -0,0 +1,144 @@
+'''
+Raw scored predictions, kept so that the threshold and symmetrization can be
+changed without running the model again.
+
+A ScoredAlignment holds every (from_token, to_token, score) the model predicted
+in the forward direction and, if it was run, the reverse direction (already
+swapped to from/to order), along with the token ranges of both texts. Applying
+a threshold is a vectorized comparison, and the symmetrization modes are set
+operations over the token pairs:
+
+- AND keeps forward pairs also predicted in reverse (the intersection);
+- OR keeps both (the union, including duplicates, as align.py always has);
+- GROW-DIAG starts from the intersection and grows it with neighboring pairs
+  from the union, as in the "grow-diag" heuristic used with GIZA++.
+'''
+from dataclasses import dataclass
+from typing import Any, Iterable
+import numpy as np
+
+SYMMETRIC_MODES = ['AND', 'OR', 'GROW-DIAG']
+
+NEIGHBORS = [(-1, 0), (0, -1), (1, 0), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)]
+
+@dataclass
+class ScoredAlignment:
+  from_token_ranges: np.ndarray  # (n, 2) start/end of each token
+  to_token_ranges: np.ndarray
+  forward: np.ndarray  # (k, 2) from_token, to_token
+  forward_scores: np.ndarray  # (k,)
+  reverse: np.ndarray | None = None
+  reverse_scores: np.ndarray | None = None
+
+  def token_pairs(self, threshold: float, symmetric: bool = False, symmetric_mode: str = 'AND') -> np.ndarray:
+    '''Returns the (from_token, to_token) pairs with scores at or above the threshold.'''
+    forward = self.forward[self.forward_scores >= threshold]
+    if not symmetric:
+      return forward
+
+    assert self.reverse is not None, 'Reverse predictions were not computed'
+    reverse = self.reverse[self.reverse_scores >= threshold]
+    return symmetrize(forward, reverse, symmetric_mode)
+
+  def to_ranges(self, threshold: float, symmetric: bool = False, symmetric_mode: str = 'AND') -> list[int]:
+    '''Same output as align.align with simplify_result=False.'''
+    token_pairs = self.token_pairs(threshold, symmetric, symmetric_mode)
+    ranges = np.concatenate([
+      self.from_token_ranges[token_pairs[:, 0]],
+      self.to_token_ranges[token_pairs[:, 1]],
+    ], axis=1)
+    return ranges.reshape(-1).tolist()
+
+  def scores(self, threshold: float, symmetric: bool = False, symmetric_mode: str = 'AND') -> np.ndarray:
+    '''
+    Returns the score of each alignment returned by `to_ranges`: the highest
+    score predicted for its token pair in either direction.
+    '''
+    predicted = [(self.forward, self.forward_scores)]
+    if symmetric:
+      predicted.append((self.reverse, self.reverse_scores))
+    keys = np.concatenate([pair_keys(pairs) for (pairs, _) in predicted])
+    scores = np.concatenate([scores for (_, scores) in predicted])
+
+    # Sorted by pair and then by descending score, so the first of each pair is
+    # its highest
+    order = np.lexsort((-scores, keys))
+    keys, scores = keys[order], scores[order]
+    first = np.concatenate([[True], keys[1:] != keys[:-1]])
+    keys, scores = keys[first], scores[first]
+
+    return scores[np.searchsorted(keys, pair_keys(self.token_pairs(threshold, symmetric, symmetric_mode)))]
+
+  def to_dict(self) -> dict[str, Any]:
+    return {
+      'fromTokenRanges': self.from_token_ranges.tolist(),
+      'toTokenRanges': self.to_token_ranges.tolist(),
+      'forward': self.forward.tolist(),
+      'forwardScores': self.forward_scores.tolist(),
+      'reverse': self.reverse.tolist() if self.reverse is not None else None,
+      'reverseScores': self.reverse_scores.tolist() if self.reverse_scores is not None else None,
+    }
+
+  @staticmethod
+  def from_dict(obj: dict[str, Any]) -> 'ScoredAlignment':
+    return ScoredAlignment(
+      as_pairs(obj['fromTokenRanges']),
+      as_pairs(obj['toTokenRanges']),
+      as_pairs(obj['forward']),
+      np.array(obj['forwardScores'], dtype=np.float64),
+      as_pairs(obj['reverse']) if obj.get('reverse') is not None else None,
+      np.array(obj['reverseScores'], dtype=np.float64) if obj.get('reverseScores') is not None else None)
+
+  @property
+  def nbytes(self) -> int:
+    return sum(x.nbytes for x in [
+      self.from_token_ranges, self.to_token_ranges, self.forward, self.forward_scores, self.reverse, self.reverse_scores
+    ] if x is not None)
+
+def as_pairs(values: Iterable) -> np.ndarray:
+  '''Converts a list of pairs (token ranges or token pairs) to an (n, 2) array.'''
+  return np.array(values, dtype=np.int32).reshape(-1, 2)
+
+def symmetrize(forward: np.ndarray, reverse: np.ndarray, symmetric_mode: str = 'AND') -> np.ndarray:
+  '''Combines forward and reverse (from_token, to_token) pairs as (k, 2) arrays.'''
+  match symmetric_mode:
+    case 'AND':
+      return forward[np.isin(pair_keys(forward), pair_keys(reverse))]
+    case 'OR':
+      return np.concatenate([forward, reverse])
+    case 'GROW-DIAG':
+      return as_pairs(grow_diag(map(tuple, forward.tolist()), map(tuple, reverse.tolist())))
+    case _:
+      raise ValueError(f'Unknown symmetric mode: {symmetric_mode}')
+
+def pair_keys(pairs: np.ndarray) -> np.ndarray:
+  '''Packs each (from_token, to_token) into a single integer for set operations.'''
+  return (pairs[:, 0].astype(np.int64) << 32) | pairs[:, 1].astype(np.int64)
+
+def grow_diag(forward: Iterable[tuple[int, int]], reverse: Iterable[tuple[int, int]]) -> list[tuple[int, int]]:
+  '''
+  Starting from the intersection, repeatedly adds pairs from the union that
+  neighbor (including diagonally) an aligned pair, if either of their tokens is
+  not yet aligned. Returns the pairs sorted.
+  '''
+  forward = set(forward)
+  reverse = set(reverse)
+  union = forward | reverse
+  alignment = forward & reverse
+  aligned_from = { i for (i, _) in alignment }
+  aligned_to = { j for (_, j) in alignment }
+
+  added = True
+  while added:
+    added = False
+    for (i, j) in sorted(alignment):
+      for (di, dj) in NEIGHBORS:
+        neighbor = (i + di, j + dj)
+        if neighbor in union and neighbor not in alignment and \
+           (neighbor[0] not in aligned_from or neighbor[1] not in aligned_to):
+          alignment.add(neighbor)
+          aligned_from.add(neighbor[0])
+          aligned_to.add(neighbor[1])
+          added = True
+
+  return sorted(alignment)
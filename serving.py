@@ -0,0 +1,197 @@
+'''
+Dynamic micro-batching for serving concurrent requests.
+
+Each model gets a single worker thread fed by a bounded queue. Requests put
+their items (marked questions for WSPAlign, sentence pairs for awesome-align)
+on the queue; the worker waits at most `max_wait` seconds after the first
+request for others to arrive, up to `max_batch` items in total, and runs them
+through the model together, so concurrent users share inference batches rather
+than each running their own, and only one thread per model uses torch.
+
+When the queue is full, new requests are rejected immediately with Overloaded
+rather than piling up. Requests that time out or whose client disconnects are
+marked as cancelled and skipped if the worker hasn't started on them yet. If a
+combined batch fails, its requests are run again in smaller batches, so that a
+bad request only fails itself.
+'''
+import os
+import queue
+import sys
+import time
+from functools import partial
+from threading import Event, Lock, Thread
+from typing import Any, Callable
+import models
+import profiling
+import qa
+
+# Time to wait after the first request for more to fill the batch, in seconds.
+DEFAULT_MAX_WAIT = float(os.environ.get('BATCH_MAX_WAIT_MS', 5)) / 1000
+
+# Number of items (questions or sentence pairs) beyond which no more requests
+# are added to the batch.
+DEFAULT_MAX_BATCH = int(os.environ.get('BATCH_MAX_ITEMS', 256))
+
+# Number of requests that can be waiting for each model before new ones are
+# rejected.
+DEFAULT_MAX_QUEUE = int(os.environ.get('BATCH_MAX_QUEUE', 64))
+
+# Seconds a request can wait for its results.
+DEFAULT_TIMEOUT = float(os.environ.get('REQUEST_TIMEOUT', 60))
+
+# How often a waiting request checks whether it's been cancelled, in seconds.
+POLL_INTERVAL = 0.05
+
+class Overloaded(Exception):
+  '''The queue for the model is full.'''
+
+class Cancelled(Exception):
+  '''The request was cancelled before it finished, e.g. by the client disconnecting.'''
+
+class Request:
+  def __init__(self, items: list[Any], timeout: float):
+    self.items = items
+    self.deadline = time.monotonic() + timeout
+    self.enqueued = time.perf_counter()
+    self.results: list[Any] | None = None
+    self.error: BaseException | None = None
+    self.cancelled = False
+    self.done = Event()
+
+  def finish(self, results: list[Any] | None = None, error: BaseException | None = None):
+    self.results = results
+    self.error = error
+    self.done.set()
+
+class MicroBatcher:
+  def __init__(
+    self,
+    name: str,
+    fn: Callable[[list[Any]], list[Any]],
+    max_batch: int = DEFAULT_MAX_BATCH,
+    max_wait: float = DEFAULT_MAX_WAIT,
+    max_queue: int = DEFAULT_MAX_QUEUE):
+    self.name = name
+    self.fn = fn
+    self.max_batch = max_batch
+    self.max_wait = max_wait
+    self.queue: queue.Queue[Request] = queue.Queue(max_queue)
+    self.thread = Thread(target=self.loop, name=f'batcher-{name}', daemon=True)
+    self.thread.start()
+
+  def submit(self, items: list[Any], timeout: float = DEFAULT_TIMEOUT) -> Request:
+    request = Request(items, timeout)
+    try:
+      self.queue.put_nowait(request)
+    except queue.Full:
+      raise Overloaded(f'Too many requests waiting for {self.name}')
+    return request
+
+  def run(self, items: list[Any], timeout: float = DEFAULT_TIMEOUT, is_cancelled: Callable[[], bool] | None = None) -> list[Any]:
+    '''Returns `fn`'s result for each item, once a batch containing them has run.'''
+    if not items:
+      return []
+
+    request = self.submit(items, timeout)
+    while not request.done.wait(POLL_INTERVAL):
+      if time.monotonic() > request.deadline:
+        request.cancelled = True
+        raise TimeoutError(f'Timed out waiting for {self.name}')
+      if is_cancelled is not None and is_cancelled():
+        request.cancelled = True
+        raise Cancelled()
+
+    if request.error is not None:
+      raise request.error
+    return request.results
+
+  def next_batch(self) -> list[Request]:
+    '''Blocks until there's a request, then collects more until the batch is full or max_wait passes.'''
+    batch = [self.queue.get()]
+    size = len(batch[0].items)
+    deadline = time.monotonic() + self.max_wait
+
+    while size < self.max_batch:
+      remaining = deadline - time.monotonic()
+      if remaining <= 0:
+        break
+      try:
+        request = self.queue.get(timeout=remaining)
+      except queue.Empty:
+        break
+      batch.append(request)
+      size += len(request.items)
+
+    now = time.monotonic()
+    for request in batch:
+      if not request.cancelled and request.deadline < now:
+        request.finish(error=TimeoutError(f'Timed out waiting for {self.name}'))
+    return [r for r in batch if not r.cancelled and not r.done.is_set()]
+
+  def loop(self):
+    while True:
+      batch = self.next_batch()
+      if not batch:
+        continue
+
+      started = time.perf_counter()
+      for request in batch:
+        profiling.observe('queue_wait', self.name, started - request.enqueued)
+      profiling.count('batches', 1)
+      profiling.count('batched_requests', len(batch))
+
+      self.run_batch(batch)
+
+  def run_batch(self, batch: list[Request]):
+    '''
+    Runs the requests together and finishes each with its results. If that
+    fails, each half of the batch is run again on its own, so that only the
+    requests that fail by themselves get the error.
+    '''
+    items = [item for request in batch for item in request.items]
+    try:
+      results = self.fn(items)
+    # Not just Exception: the tokenizers' PanicException is a BaseException,
+    # and letting anything escape would kill the worker thread for good
+    except BaseException as e:
+      if len(batch) > 1:
+        middle = len(batch) // 2
+        self.run_batch(batch[:middle])
+        self.run_batch(batch[middle:])
+        return
+      print(f'Request for {self.name} failed: {e!r}', file=sys.stderr)
+      batch[0].finish(error=e)
+      return
+
+    offset = 0
+    for request in batch:
+      request.finish(results[offset:offset + len(request.items)])
+      offset += len(request.items)
+
+def predict_wsp(kind: str, model: str, batch_size: int, items: list[tuple[str, str]]) -> list[dict | None]:
+  return qa.predict(models.get(kind, model), [q for (q, _) in items], [c for (_, c) in items], batch_size)
+
+def extract_awesome(kind: str, model: str, items: list[tuple[str, list[tuple[int, int]], str, list[tuple[int, int]]]]) -> list[list[tuple[int, int]]]:
+  from awesome import extract_alignments
+  return extract_alignments(model, items, quantized=kind.endswith('-int8'))
+
+_batchers: dict[tuple[str, str], MicroBatcher] = {}
+_lock = Lock()
+
+def get_batcher(kind: str, model: str) -> MicroBatcher:
+  '''Returns the batcher for the model, starting its worker thread on first use.'''
+  with _lock:
+    if (kind, model) not in _batchers:
+      fn = partial(predict_wsp, kind, model, qa.DEFAULT_BATCH_SIZE) if kind.startswith('wsp') else partial(extract_awesome, kind, model)
+      _batchers[(kind, model)] = MicroBatcher(f'{kind}:{model}', fn)
+    return _batchers[(kind, model)]
+
+def wsp_predictor(model: str, timeout: float = DEFAULT_TIMEOUT, is_cancelled: Callable[[], bool] | None = None, quantized: bool = False):
+  '''Returns a `predict` for align.predict_many that goes through the model's batcher.'''
+  batcher = get_batcher(models.get_kind('wsp', quantized), model)
+  return lambda questions, contexts: batcher.run(list(zip(questions, contexts)), timeout, is_cancelled)
+
+def awesome_extractor(model: str, timeout: float = DEFAULT_TIMEOUT, is_cancelled: Callable[[], bool] | None = None, quantized: bool = False):
+  '''Returns an `extract` for awesome.align_many that goes through the model's batcher.'''
+  batcher = get_batcher(models.get_kind('awesome', quantized), model)
+  return lambda items: batcher.run(items, timeout, is_cancelled)
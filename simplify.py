@@ -11,16 +11,149 @@ Two alignments are eligible to be merged if:
 
 This doesn't produce the optimal result in all cases (it fails the "abc-abc"
 example in simplify_slow.py, for instance), but it's good enough for real-world
-sentence pairs and executes in milliseconds rather than minutes.
+sentence pairs and executes in milliseconds rather than minutes. The "exact"
+mode finds the most compact result instead (see simplify_exact.py).
+
+Each pass goes through the alignments in sorted order, merging each into the
+first one it can be, repeatedly until nothing changes. Since an alignment can
+only be merged with one that starts before the end of its "from" span (or after
+it, separated only by whitespace), the search for a merge stops at the first
+alignment starting past that point, and whether a gap is only whitespace is
+looked up in a precomputed index of the text. `simplify_naive` is the
+all-pairs version, kept to check that the results are identical (see
+test_simplify.py).
 '''
 import re
+from itertools import accumulate
+import profiling
 
-def simplify(alignments: list[int], from_text: str, to_text: str) -> list[int]:
+# "exact" finds the most compact result, within a time budget (see
+# simplify_exact.py).
+SIMPLIFY_MODES = ['greedy', 'exact']
+
+class Whitespace:
+  '''Answers whether parts of a text contain only whitespace in constant time.'''
+
+  def __init__(self, text: str):
+    is_non_whitespace = [0] * len(text)
+    for match in re.finditer(r'\S', text):
+      is_non_whitespace[match.start()] = 1
+
+    # Number of non-whitespace characters before each index
+    self.counts = [0, *accumulate(is_non_whitespace)]
+
+    # Index of the first non-whitespace character at or after each index; if
+    # there isn't one, any gap extending to the end is only whitespace
+    self.next_non_whitespace = [float('inf')] * (len(text) + 1)
+    for i in range(len(text) - 1, -1, -1):
+      self.next_non_whitespace[i] = i if is_non_whitespace[i] else self.next_non_whitespace[i + 1]
+
+  def is_whitespace(self, start: int, end: int) -> bool:
+    r'''Same as `not re.search(r'\S', text[start:end])`.'''
+    length = len(self.counts) - 1
+    return start >= end or self.counts[min(end, length)] == self.counts[min(start, length)]
+
+  def next_non_whitespace_after(self, index: int) -> float:
+    return self.next_non_whitespace[index] if index < len(self.next_non_whitespace) else float('inf')
+
+  def is_overlapping_or_adjacent(self, start1: int, end1: int, start2: int, end2: int) -> bool:
+    '''Same as `is_overlapping_or_adjacent` for this text.'''
+    return (end1 < start2 and self.is_whitespace(end1, start2)) or \
+           (start1 <= end2 and end1 >= start2) or \
+           (start1 > end2 and self.is_whitespace(end2, start1))
+
+def simplify(alignments: list[int], from_text: str, to_text: str, mode: str = 'greedy', time_budget: float | None = None) -> list[int]:
+  '''
+  Merges the alignments with `mode`. `time_budget` limits the seconds spent by
+  the exact mode, which otherwise uses simplify_exact.current_time_budget.
+  '''
+  profiling.count('simplified_alignments', len(alignments) // 4)
+
+  if mode == 'exact':
+    from simplify_exact import simplify as simplify_exact
+    with profiling.stage('simplify_exact'):
+      return simplify_exact(alignments, from_text, to_text, time_budget)
+
+  with profiling.stage('simplify'):
+    return simplify_greedy(alignments, from_text, to_text)
+
+def simplify_greedy(alignments: list[int], from_text: str, to_text: str) -> list[int]:
   # Group into tuples, remove duplicates from symmetrizing, and sort
   result = list(set(group_alignments(alignments)))
   result.sort()
 
-  removed = set()
+  from_whitespace = Whitespace(from_text)
+  to_whitespace = Whitespace(to_text)
+
+  removed: set[int] = set()
+  modified_list = True
+
+  while modified_list:
+    modified_list = False
+
+    for i, current in enumerate(result):
+      if i in removed:
+        continue
+
+      for j in range(i + 1, len(result)):
+        other = result[j]
+
+        # The rest of the list starts even later, and `current` only grows
+        if other[0] > from_whitespace.next_non_whitespace_after(current[1]):
+          break
+
+        if j in removed:
+          continue
+
+        merged = merge_spans(current, other, from_whitespace, to_whitespace)
+        if merged is None:
+          continue
+
+        result[i] = current = merged
+        removed.add(j)
+        modified_list = True
+
+    result = sorted(x for i, x in enumerate(result) if not i in removed)
+    removed.clear()
+
+  return ungroup_alignments(result)
+
+def merge_spans(
+  left: tuple[int, int, int, int],
+  right: tuple[int, int, int, int],
+  from_whitespace: Whitespace,
+  to_whitespace: Whitespace) -> tuple[int, int, int, int] | None:
+  '''Same as `merge_alignments`, with the texts' whitespace indexed.'''
+
+  if left[0] >= right[0] and left[1] <= right[1] and \
+     left[2] >= right[2] and left[3] <= right[3]:
+    return right
+
+  if right[0] >= left[0] and right[1] <= left[1] and \
+     right[2] >= left[2] and right[3] <= left[3]:
+    return left
+
+  if left[0] == right[0] and left[1] == right[1] and \
+     to_whitespace.is_overlapping_or_adjacent(left[2], left[3], right[2], right[3]):
+    return (left[0], left[1], min(left[2], right[2]), max(left[3], right[3]))
+
+  if left[2] == right[2] and left[3] == right[3] and \
+     from_whitespace.is_overlapping_or_adjacent(left[0], left[1], right[0], right[1]):
+    return (min(left[0], right[0]), max(left[1], right[1]), left[2], left[3])
+
+  return None
+
+def simplify_naive(alignments: list[int], from_text: str, to_text: str) -> list[int]:
+  '''
+  The all-pairs version of `simplify_greedy`, which tries every pair of
+  alignments without using the whitespace index. Like it, merged-away
+  alignments are removed by index, so an identical alignment elsewhere in the
+  list is kept.
+  '''
+  result = list(set(group_alignments(alignments)))
+  result.sort()
+
+  removed: set[int] = set()
   modified_list = True
 
   # _debug(result, from_text, to_text)
@@ -29,11 +162,11 @@ def simplify(alignments: list[int], from_text: str, to_text: str) -> list[int]:
     modified_list = False
 
     for i, current in enumerate(result):
-      if current in removed:
+      if i in removed:
         continue
 
-      for other in result[i + 1:]:
-        if other in removed:
+      for j, other in enumerate(result[i + 1:], i + 1):
+        if j in removed:
           continue
 
         merged = merge_alignments(current, other, from_text, to_text)
@@ -41,12 +174,12 @@ def simplify(alignments: list[int], from_text: str, to_text: str) -> list[int]:
           continue
 
         result[i] = current = merged
-        removed.add(other)
+        removed.add(j)
         modified_list = True
 
-        # _debug([x for x in result if not x in removed], from_text, to_text)
+        # _debug([x for k, x in enumerate(result) if not k in removed], from_text, to_text)
 
-    result = sorted(x for x in result if not x in removed)
+    result = sorted(x for i, x in enumerate(result) if not i in removed)
     removed.clear()
 
   return ungroup_alignments(result)
@@ -0,0 +1,233 @@
+'''
+Finds the most compact simplification of word alignments, like simplify_slow.py,
+in seconds rather than minutes.
+
+The result is the same as the breadth-first search in simplify_slow.py: of all
+the sets of alignments that can be reached by merging (see simplify.py), the
+one with the fewest alignments, then the shortest total span length. Rather
+than trying every merge order, it:
+
+- Represents each set of alignments as a sorted tuple with no duplicates, and
+  remembers every one it has seen, so that merge orders arriving at the same
+  set are only explored once;
+- Splits the alignments into independent components. Only alignments that
+  touch (overlap, are adjacent, or are separated by only whitespace) on both
+  sides can be merged, and anything touching a merged alignment touched one of
+  the two it came from, so alignments that aren't connected by a chain of
+  touching alignments can never be merged with each other, and the best
+  simplification of each component can be found separately;
+- Starts from the greedy result from simplify.py as the best so far, then
+  searches each component best-first, ordered by a lower bound on what can
+  still be achieved, and stops as soon as nothing left to search could beat it.
+
+The lower bound relies on merging never covering anything new: every pair of a
+"from" and a "to" character within a merged alignment (ignoring whitespace)
+was already within one of the two it came from. So two alignments whose
+bounding box includes a pair that no original alignment covers can never end
+up in the same merged alignment, and a set of alignments that are pairwise
+like that needs at least that many alignments in the result. A result with
+exactly that many has one of them in each merged alignment, and any alignment
+that can only share with one of them has to be in the same merged alignment,
+so the total span is at least the sum of the bounding boxes of each of them
+with the alignments that can only go with it. (Any result with more alignments
+is worse regardless of its total span.)
+
+If the search takes longer than `time_budget` seconds in total (2 by default,
+or SIMPLIFY_TIME_BUDGET), the best result found so far for each component is
+used, which is never worse than the greedy one.
+
+test_simplify.py compares it against simplify_slow.py on small random inputs.
+'''
+import heapq
+import itertools
+import os
+import time
+import numpy as np
+from simplify import Whitespace, group_alignments, merge_spans, simplify_greedy, ungroup_alignments
+
+Alignment = tuple[int, int, int, int]
+State = tuple[Alignment, ...]
+
+# Seconds spent searching before falling back to the greedy result for the
+# components that are left.
+DEFAULT_TIME_BUDGET = float(os.environ.get('SIMPLIFY_TIME_BUDGET', 2.0))
+
+# Used when `simplify` isn't given a time budget; set by the
+# --simplify-time-budget option of the command-line tools.
+current_time_budget = DEFAULT_TIME_BUDGET
+
+class Coverage:
+  '''
+  Answers whether every pair of non-whitespace "from" and "to" characters in a
+  rectangle is covered by one of the alignments, in constant time.
+  '''
+
+  def __init__(self, alignments: State, from_text: str, to_text: str):
+    # Only the bounding box of the alignments is indexed
+    self.from_offset = min(x[0] for x in alignments)
+    self.to_offset = min(x[2] for x in alignments)
+    from_chars = from_text[self.from_offset:max(x[1] for x in alignments)]
+    to_chars = to_text[self.to_offset:max(x[3] for x in alignments)]
+
+    gaps = np.outer([not c.isspace() for c in from_chars], [not c.isspace() for c in to_chars])
+    for (from_start, from_end, to_start, to_end) in alignments:
+      gaps[from_start - self.from_offset:from_end - self.from_offset, to_start - self.to_offset:to_end - self.to_offset] = False
+
+    # Number of uncovered pairs of non-whitespace characters before each (i, j)
+    self.counts = np.zeros((len(from_chars) + 1, len(to_chars) + 1), dtype=np.int32)
+    self.counts[1:, 1:] = gaps.cumsum(axis=0).cumsum(axis=1)
+    self.counts = self.counts.tolist()
+
+    # The same pairs come up in most of the states searched
+    self.shared: dict[tuple[Alignment, Alignment], bool] = {}
+
+  def is_covered(self, from_start: int, from_end: int, to_start: int, to_end: int) -> bool:
+    (c, i, j) = (self.counts, self.from_offset, self.to_offset)
+    return c[from_end - i][to_end - j] - c[from_start - i][to_end - j] - c[from_end - i][to_start - j] + c[from_start - i][to_start - j] == 0
+
+  def can_share(self, a: Alignment, b: Alignment) -> bool:
+    '''Whether the alignments could ever be part of the same merged alignment.'''
+    if (a, b) not in self.shared:
+      self.shared[(a, b)] = self.is_covered(min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3]))
+    return self.shared[(a, b)]
+
+class Search:
+  def __init__(self, from_text: str, to_text: str, deadline: float):
+    self.from_text = from_text
+    self.to_text = to_text
+    self.from_whitespace = Whitespace(from_text)
+    self.to_whitespace = Whitespace(to_text)
+    self.deadline = deadline
+
+  def touches(self, a: Alignment, b: Alignment) -> bool:
+    '''Whether the alignments overlap or are adjacent on both sides.'''
+    return self.from_whitespace.is_overlapping_or_adjacent(a[0], a[1], b[0], b[1]) and \
+           self.to_whitespace.is_overlapping_or_adjacent(a[2], a[3], b[2], b[3])
+
+  def components(self, state: State) -> list[State]:
+    '''Splits the alignments into groups that can never be merged with each other.'''
+    parents = list(range(len(state)))
+
+    def find(i: int) -> int:
+      while parents[i] != i:
+        parents[i] = parents[parents[i]]
+        i = parents[i]
+      return i
+
+    # The state is sorted, so only alignments starting before the end of the
+    # current one (or after it, separated by whitespace) need to be checked
+    for i, a in enumerate(state):
+      for j in range(i + 1, len(state)):
+        b = state[j]
+        if b[0] > self.from_whitespace.next_non_whitespace_after(a[1]):
+          break
+        if self.touches(a, b):
+          parents[find(j)] = find(i)
+
+    components: dict[int, list[Alignment]] = {}
+    for i, alignment in enumerate(state):
+      components.setdefault(find(i), []).append(alignment)
+    return [tuple(alignments) for alignments in components.values()]
+
+  def solve(self, component: State) -> State:
+    '''
+    Returns the best state reachable from `component`, or the best found so far
+    if the time budget runs out, which is never worse than the greedy result.
+    '''
+    if len(component) <= 1:
+      return component
+
+    best = tuple(sorted(group_alignments(simplify_greedy(ungroup_alignments(list(component)), self.from_text, self.to_text))))
+    best_cost = cost(best)
+    coverage = Coverage(component, self.from_text, self.to_text)
+    separate = get_separate(component, coverage)
+    visited = { component }
+
+    # A state's bound is only computed once it comes to the front of the queue;
+    # until then it's queued with its parent's, which is also a lower bound for
+    # it since anything reachable from it is reachable from its parent
+    queue = [(lower_bound(component, coverage, separate), cost(component), True, component)]
+
+    while queue and time.perf_counter() < self.deadline:
+      bound, _, exact, current = heapq.heappop(queue)
+      if bound >= best_cost:
+        break
+      if not exact:
+        heapq.heappush(queue, (max(bound, lower_bound(current, coverage, separate)), cost(current), True, current))
+        continue
+
+      for left, right in itertools.combinations(current, 2):
+        merged = merge_spans(left, right, self.from_whitespace, self.to_whitespace)
+        if merged is None:
+          continue
+
+        child = tuple(sorted({ *(x for x in current if x != left and x != right), merged }))
+        if child in visited:
+          continue
+        visited.add(child)
+
+        if cost(child) < best_cost:
+          best, best_cost = child, cost(child)
+        heapq.heappush(queue, (bound, cost(child), False, child))
+
+    return best
+
+def cost(state: State) -> tuple[int, int]:
+  '''Fewest alignments, then shortest spans, as in simplify_slow.compare.'''
+  return (len(state), sum((x[1] - x[0]) + (x[3] - x[2]) for x in state))
+
+def get_separate(component: State, coverage: Coverage) -> list[Alignment]:
+  '''
+  Returns alignments of the component, starting with the longest, that can't
+  share a merged alignment with each other and so each end up in a different
+  one. Since merging only ever contains them, this holds for every state
+  reached from the component.
+  '''
+  separate: list[Alignment] = []
+  for x in sorted(component, key=lambda x: (x[1] - x[0]) + (x[3] - x[2]), reverse=True):
+    if not any(coverage.can_share(x, y) for y in separate):
+      separate.append(x)
+  return separate
+
+def lower_bound(state: State, coverage: Coverage, separate: list[Alignment]) -> tuple[int, int]:
+  '''The best cost that could possibly be reached from the state.'''
+  # With exactly len(separate) alignments in the result, each alignment that
+  # can only share with one of `separate` is merged into the one containing it
+  boxes = list(separate)
+  for x in state:
+    options = [i for (i, y) in enumerate(separate) if coverage.can_share(x, y)]
+    if len(options) == 1:
+      (i,) = options
+      boxes[i] = (min(boxes[i][0], x[0]), max(boxes[i][1], x[1]), min(boxes[i][2], x[2]), max(boxes[i][3], x[3]))
+
+  length = max(
+    cost(tuple(boxes))[1],
+    covered_length((x[0], x[1]) for x in state) + covered_length((x[2], x[3]) for x in state))
+  return (len(separate), length)
+
+def covered_length(ranges) -> int:
+  '''Number of characters within any of the ranges.'''
+  total = 0
+  end = None
+  for (range_start, range_end) in sorted(ranges):
+    if end is None or range_start > end:
+      total += range_end - range_start
+      end = range_end
+    elif range_end > end:
+      total += range_end - end
+      end = range_end
+  return total
+
+def simplify(alignments: list[int], from_text: str, to_text: str, time_budget: float | None = None) -> list[int]:
+  state = tuple(sorted(set(group_alignments(alignments))))
+  result: list[Alignment] = []
+
+  # The budget is shared by every component, so that it bounds the whole call
+  if time_budget is None:
+    time_budget = current_time_budget
+  search = Search(from_text, to_text, time.perf_counter() + time_budget)
+
+  for component in search.components(state):
+    result += search.solve(component)
+
+  return ungroup_alignments(sorted(result))
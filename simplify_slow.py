@@ -18,6 +18,9 @@ already, so I've instead opted for a simpler, repeated-forward-pass approach
 which, while it doesn't produce the optimal result in all cases, is good enough
 for real-world sentence pairs -- and more importantly is 8000x faster.
 
+simplify_exact.py finds the same result as this search in a fraction of the
+time, and is what the "exact" simplify mode uses; this is kept for reference.
+
 Examples:
 
   a-ab b-ab c-ab ab-c c-abc          a-ab a-bc b-bc c-bc d-bc b-abc
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+'''
+Memory-mapped snapshots of models, so that processes share one copy of the
+weights.
+
+Loading a checkpoint normally reads the weights into memory that belongs to
+the process, so every worker or server process holds its own copy of BERT and
+re-reads it from the checkpoint on startup. A snapshot stores the weights of
+each tensor uncompressed in a single file that's memory-mapped when loaded:
+the model's tensors point directly into the mapping, so loading reads nothing
+up front, and the pages come from the OS page cache, which every process
+mapping the same file shares.
+
+Snapshots are made once from the usual model names or paths:
+
+  ./snapshot.py wsp:qiyuw/WSPAlign-ft-kftt awesome:./models/model_without_co
+
+and used in place of the originals by every loader in models.py when
+MODEL_SNAPSHOTS is set to the directory they were written to. The "-int8"
+kinds are quantized after loading the snapshot, which speeds up their cold
+start, but the quantized weights are still private to each process.
+'''
+import argparse
+import os
+import sys
+import time
+from typing import Any, Callable
+
+# Directory that snapshots are written to and loaded from.
+SNAPSHOT_DIR = os.environ.get('MODEL_SNAPSHOTS')
+
+WEIGHTS_FILE = 'weights.pt'
+
+def get_path(directory: str, kind: str, name: str) -> str:
+  '''Returns the snapshot directory of a model, e.g. "wsp/qiyuw--WSPAlign-ft-kftt".'''
+  return os.path.join(directory, kind, os.path.normpath(name).strip(os.sep).replace(os.sep, '--'))
+
+def find(kind: str, name: str) -> str | None:
+  '''Returns the snapshot directory of the model if MODEL_SNAPSHOTS is set and has one.'''
+  if SNAPSHOT_DIR is None:
+    return None
+  path = get_path(SNAPSHOT_DIR, kind, name)
+  return path if os.path.exists(os.path.join(path, WEIGHTS_FILE)) else None
+
+def save_weights(model: Any, path: str):
+  '''Writes every parameter and buffer of the model, including tied and non-persistent ones.'''
+  import torch
+  tensors = {
+    **{ name: t.detach() for (name, t) in model.named_parameters(remove_duplicate=False) },
+    **{ name: t for (name, t) in model.named_buffers(remove_duplicate=False) },
+  }
+  # Written under a temporary name so that a process loading the snapshot
+  # never sees a partial file
+  temp_path = os.path.join(path, WEIGHTS_FILE + '.tmp')
+  torch.save({ name: t.contiguous() for (name, t) in tensors.items() }, temp_path)
+  os.replace(temp_path, os.path.join(path, WEIGHTS_FILE))
+
+def load_weights(build: Callable[[], Any], path: str) -> Any:
+  '''
+  Builds the model without allocating its weights, then points each of its
+  tensors at the memory-mapped snapshot.
+  '''
+  import torch
+  with torch.device('meta'):
+    model = build()
+
+  tensors = torch.load(os.path.join(path, WEIGHTS_FILE), mmap=True, weights_only=True)
+  for (name, tensor) in tensors.items():
+    (module_name, _, attr) = name.rpartition('.')
+    module = model.get_submodule(module_name)
+    if attr in module._parameters:
+      module._parameters[attr] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+      module._buffers[attr] = tensor
+
+  missing = [name for (name, t) in [*model.named_parameters(), *model.named_buffers()] if t.is_meta]
+  if missing:
+    raise ValueError(f'Snapshot {path} is missing {", ".join(missing)}')
+
+  model.eval()
+  return model
+
+def save(kind: str, name: str, directory: str) -> str:
+  '''Loads the model the usual way and writes its snapshot, returning the snapshot directory.'''
+  import models
+  if kind not in ('wsp', 'awesome'):
+    raise ValueError(f'Can only snapshot wsp and awesome models, not {kind}')
+
+  path = get_path(directory, kind, name)
+  os.makedirs(path, exist_ok=True)
+
+  value = models.LOADERS[kind](name)
+  (model, tokenizer) = (value.model, value.tokenizer)
+  model.config.save_pretrained(path)
+  tokenizer.save_pretrained(path)
+  save_weights(model, path)
+  return path
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument('models', type=str, nargs='+', help='Models as "kind:name", e.g. wsp:qiyuw/WSPAlign-ft-kftt')
+  parser.add_argument('--output', type=str, default=SNAPSHOT_DIR or './models/snapshots', help='Directory to write the snapshots to; defaults to MODEL_SNAPSHOTS')
+  args = parser.parse_args()
+
+  for spec in args.models:
+    (kind, name) = spec.strip().split(':', 1)
+    start = time.perf_counter()
+    path = save(kind, name, args.output)
+    size = os.path.getsize(os.path.join(path, WEIGHTS_FILE))
+    print(f'Wrote {path} ({size / 2**20:.1f} MiB) in {time.perf_counter() - start:.2f}s', file=sys.stderr)
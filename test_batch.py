@@ -0,0 +1,26 @@
+'''
+Tests for reading input and resuming in batch.py.
+
+  python -m pytest test_batch.py
+'''
+import io
+import pytest
+import batch
+
+def test_read_pairs_skips_blank_lines():
+  file = io.StringIO('a\tb\n\n  \nc\td\n\n')
+  assert list(batch.read_pairs(file, 'tsv')) == [('a', 'b'), ('c', 'd')]
+
+def test_read_pairs_reports_the_line_number():
+  file = io.StringIO('a\tb\n\nc\n')
+  with pytest.raises(ValueError, match='Line 3'):
+    list(batch.read_pairs(file, 'tsv'))
+
+def test_count_complete_lines_truncates_a_partial_line(tmp_path, monkeypatch):
+  # Small blocks so that lines span several of them
+  monkeypatch.setattr(batch, 'COUNT_BLOCK_SIZE', 4)
+  path = tmp_path / 'output.txt'
+  path.write_bytes(b'1,2,3,4\n\n5,6,7,8\n9,1')
+  assert batch.count_complete_lines(str(path)) == 3
+  assert path.read_bytes() == b'1,2,3,4\n\n5,6,7,8\n'
+  assert batch.count_complete_lines(str(tmp_path / 'missing.txt')) == 0
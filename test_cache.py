@@ -0,0 +1,100 @@
+'''
+Tests for the size accounting and disk tiers in cache.py.
+
+  python -m pytest test_cache.py
+'''
+import json
+import os
+import sqlite3
+import cache
+
+def test_size_includes_key_and_overhead():
+  # Values measured as empty still fill the cache through their keys
+  lru = cache.LRUCache(10_000, size_of=lambda value: 0)
+  for i in range(1000):
+    lru.put(('ja', 'テキスト' * 20 + str(i)), i)
+
+  stats = lru.stats()
+  assert 0 < stats['entries'] < 1000
+  assert stats['bytes'] <= stats['maxBytes']
+  assert lru.get(('ja', 'テキスト' * 20 + '999')) == 999
+  assert lru.get(('ja', 'テキスト' * 20 + '0')) is None
+
+def test_sqlite_store_evicts_least_recently_used(tmp_path):
+  store = cache.SqliteStore(str(tmp_path / 'cache.db'), max_bytes=1000)
+  for i in range(100):
+    store.put(['text', i], [i] * 10)
+    if i >= 1:
+      # Kept in use, so never the least recently used
+      assert store.get(['text', 0]) == [0] * 10
+
+  assert store.get(['text', 0]) is not None
+  assert store.get(['text', 99]) is not None
+  assert store.get(['text', 50]) is None
+
+  # The size is kept across reopening
+  reopened = cache.SqliteStore(str(tmp_path / 'cache.db'), max_bytes=1000)
+  assert 0 < reopened._bytes <= 1000
+  assert reopened.get(['text', 99]) == [99] * 10
+
+def test_sqlite_store_adds_sizes_to_old_databases(tmp_path):
+  path = str(tmp_path / 'cache.db')
+  connection = sqlite3.connect(path)
+  connection.execute('CREATE TABLE cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+  connection.execute("INSERT INTO cache VALUES ('\"a\"', '[1, 2]')")
+  connection.commit()
+  connection.close()
+
+  store = cache.SqliteStore(path, max_bytes=100)
+  assert store.get('a') == [1, 2]
+  assert store._bytes == len('"a"') + len('[1, 2]')
+
+def test_sqlite_store_evicts_exactly_after_migrating(tmp_path):
+  path = str(tmp_path / 'cache.db')
+  connection = sqlite3.connect(path)
+  connection.execute('CREATE TABLE cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+  connection.executemany('INSERT INTO cache VALUES (?, ?)', [(f'"{i:02}"', '[1, 2]') for i in range(50)])
+  connection.commit()
+  connection.close()
+
+  # Just over the limit, by an entry's size
+  store = cache.SqliteStore(path, max_bytes=49 * len('"00"[1, 2]'))
+  store.put('new', [])
+
+  (count, size) = store._connection.execute('SELECT count(*), sum(size) FROM cache').fetchone()
+  assert store._bytes == size <= store.max_bytes
+  assert count == 49
+  # The first written are the first evicted
+  assert store.get('00') is None and store.get('01') is None
+  assert store.get('49') == [1, 2]
+
+def save_json(value, path: str):
+  with open(path, 'w') as file:
+    json.dump(value, file)
+
+def load_json(path: str):
+  with open(path) as file:
+    return json.load(file)
+
+def test_disk_hit_spills_what_it_evicts(tmp_path):
+  store = cache.DirectoryStore(str(tmp_path), save_json, load_json)
+  lru = cache.LRUCache(2 * (cache.ENTRY_OVERHEAD + cache.key_size('a') + 100), size_of=lambda value: 100, store=store)
+  lru.put('a', 1)
+  lru.put('b', 2)
+  lru.put('c', 3)  # Spills a
+  assert lru.get('a') == 1  # Read back, evicting b
+  assert store.get('b') == 2
+
+def test_directory_store_evicts_least_recently_used(tmp_path):
+  store = cache.DirectoryStore(str(tmp_path), save_json, load_json, max_bytes=1000)
+  for i in range(100):
+    store.put(i, 'x' * 98)
+    # Written in order, long ago, but 0 is then used now
+    os.utime(store.get_path(i), (i, i))
+    assert store.get(0) is not None
+
+  sizes = [entry.stat().st_size for entry in os.scandir(tmp_path)]
+  assert store._bytes == sum(sizes) <= 1000
+  assert store.get(0) is not None
+  assert store.get(99) is not None
+  assert store.get(50) is None
@@ -0,0 +1,33 @@
+'''
+Tests for splitting long documents into sentences in document.py.
+
+  python -m pytest test_document.py
+'''
+import document
+
+def test_chunks_end_at_line_breaks():
+  text = 'あいう\nえお\n' * 10 + 'かきくけこさ。' * 10
+  chunks = document.get_chunks(text, max_bytes=40)
+  assert chunks[0][0] == 0 and chunks[-1][1] == len(text)
+  assert all(end == next_start for ((_, end), (next_start, _)) in zip(chunks, chunks[1:]))
+  assert all(len(text[start:end].encode('utf-8')) <= 40 for (start, end) in chunks)
+  # Whole lines, except for the line that's too long by itself
+  long_line = text.index('か')
+  assert all(text[end - 1] == '\n' for (_, end) in chunks if end <= long_line)
+  # Which is cut after sentence ends
+  assert [text[start:end] for (start, end) in chunks if start >= long_line] == ['かきくけこさ。'] * 10
+
+def test_long_japanese_document():
+  sentence = '吾輩は猫である。名前はまだ無い。'
+  lines = [sentence * 20 + str(i) for i in range(100)]
+  text = '\n'.join(lines)
+  assert len(text.encode('utf-8')) > 49149
+
+  # The same sentences as splitting each line on its own
+  expected = []
+  start = 0
+  for line in lines:
+    expected += [(start + s, start + e) for (s, e) in document.get_sentence_ranges('ja', line)]
+    start += len(line) + 1
+  assert document.get_sentence_ranges('ja', text) == expected
+  assert expected[0] == (0, len('吾輩は猫である。'))
@@ -0,0 +1,17 @@
+'''
+Checks that every module can be imported on its own, as a library, without
+circular imports between them.
+
+  python -m pytest test_imports.py
+'''
+import os
+import subprocess
+import sys
+import pytest
+
+MODULES = ['batch', 'parallel', 'compare_quantized', 'document', 'benchmark', 'snapshot', 'binary']
+
+@pytest.mark.parametrize('module', MODULES)
+def test_import(module: str):
+  # Each in a fresh interpreter, since the order of earlier imports can hide a cycle
+  subprocess.run([sys.executable, '-c', f'import {module}'], cwd=os.path.dirname(os.path.abspath(__file__)), check=True)
@@ -0,0 +1,36 @@
+'''
+Tests for the model registry in models.py, with stand-in loaders.
+
+  python -m pytest test_models.py
+'''
+import threading
+import time
+import models
+
+def test_cold_load_doesnt_block_other_models(monkeypatch):
+  loads: list[str] = []
+  def load_slow(name: str) -> str:
+    loads.append(name)
+    time.sleep(0.5)
+    return name
+
+  monkeypatch.setitem(models.LOADERS, 'slow', load_slow)
+  monkeypatch.setitem(models.LOADERS, 'fast', lambda name: name)
+  registry = models.ModelRegistry()
+  registry.get('fast', 'warm')
+
+  threads = [threading.Thread(target=registry.get, args=('slow', 'cold')) for _ in range(3)]
+  for thread in threads:
+    thread.start()
+  time.sleep(0.1)
+
+  start = time.perf_counter()
+  assert registry.get('fast', 'warm') == 'warm'
+  assert registry.get('fast', 'other') == 'other'
+  assert time.perf_counter() - start < 0.2
+
+  for thread in threads:
+    thread.join()
+  # Concurrent requests for the cold model share the one load
+  assert loads == ['cold']
+  assert registry.get('slow', 'cold') == 'cold'
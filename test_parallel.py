@@ -0,0 +1,84 @@
+'''
+Tests for ordering and retries in parallel.py, with a stand-in for the model
+in workers forked from the test.
+
+  python -m pytest test_parallel.py
+'''
+import argparse
+import io
+import os
+import time
+import pytest
+import batch
+import parallel
+
+def get_args(workers: int) -> argparse.Namespace:
+  return argparse.Namespace(workers=workers, threads_per_worker=1, fork=True, format='tsv', chunk_size=1)
+
+def get_input(count: int) -> io.StringIO:
+  return io.StringIO(''.join(f'{i}\t{i}\n' for i in range(count)))
+
+class ListWriter:
+  def __init__(self, on_write=None):
+    self.results: list[list[int]] = []
+    self.on_write = on_write
+
+  def write(self, result: list[int], scores=None):
+    if self.on_write is not None:
+      self.on_write()
+    self.results.append(result)
+
+  def flush(self):
+    pass
+
+@pytest.fixture(autouse=True)
+def no_models(monkeypatch):
+  monkeypatch.setattr(parallel, 'get_model_specs', lambda args: [])
+
+def test_slow_chunk_limits_read_ahead(monkeypatch):
+  def align_chunk(args, pairs):
+    if pairs[0][0] == '0':
+      time.sleep(1)
+    return [([int(a)], None) for (a, _) in pairs]
+  monkeypatch.setattr(batch, 'align_chunk', align_chunk)
+
+  input_file = get_input(50)
+  read_at_first_write: list[int] = []
+  writer = ListWriter(lambda: read_at_first_write.append(input_file.tell()) if not read_at_first_write else None)
+  parallel.run(get_args(2), input_file, writer, 0)
+
+  assert writer.results == [[i] for i in range(50)]
+  # The first chunk is slow, but no more than 2 per worker are read meanwhile
+  assert read_at_first_write[0] <= len(get_input(4 + 1).getvalue())
+
+def test_crash_only_counts_against_running_chunks(monkeypatch, tmp_path):
+  # Every chunk crashes its worker the first time it runs. The chunks queued
+  # behind it are lost with the pool each time, but aren't retried as often.
+  def align_chunk(args, pairs):
+    marker = tmp_path / pairs[0][0]
+    if not marker.exists():
+      marker.touch()
+      os._exit(1)
+    return [([int(a)], None) for (a, _) in pairs]
+  monkeypatch.setattr(batch, 'align_chunk', align_chunk)
+  monkeypatch.setattr(parallel, 'MAX_RETRIES', 1)
+
+  writer = ListWriter()
+  parallel.run(get_args(1), get_input(4), writer, 0)
+  assert writer.results == [[i] for i in range(4)]
+
+def test_chunk_that_always_crashes_fails(monkeypatch):
+  def align_chunk(args, pairs):
+    if pairs[0][0] == '2':
+      os._exit(1)
+    return [([int(a)], None) for (a, _) in pairs]
+  monkeypatch.setattr(batch, 'align_chunk', align_chunk)
+
+  with pytest.raises(RuntimeError, match='Chunk 2 failed'):
+    parallel.run(get_args(2), get_input(6), ListWriter(), 0)
+
+def test_model_specs_use_the_current_model(monkeypatch):
+  monkeypatch.undo()  # The real get_model_specs, not the no_models stand-in
+  monkeypatch.setattr(parallel.align, 'MODEL', 'configured-later')
+  args = argparse.Namespace(method='wsp', quantized=False)
+  assert parallel.get_model_specs(args) == ['wsp:configured-later']
@@ -0,0 +1,14 @@
+'''
+Tests for the Prometheus export in profiling.py.
+
+  python -m pytest test_profiling.py
+'''
+import profiling
+
+def test_label_values_are_escaped():
+  recorder = profiling.Recorder()
+  recorder.observe('queue_wait', 'awesome:a"b\\c\nd', 0.1)
+  text = recorder.to_prometheus()
+  assert 'method="awesome:a\\"b\\\\c\\nd"' in text
+  # Every sample is still on one line
+  assert all(line.startswith(('#', 'alignment_')) for line in text.splitlines())
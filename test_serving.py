@@ -0,0 +1,48 @@
+'''
+Tests for failures in the micro-batching of serving.py, with a stand-in model.
+
+  python -m pytest test_serving.py
+'''
+import threading
+import pytest
+import serving
+
+class Panic(BaseException):
+  '''Like the tokenizers' PanicException, which isn't an Exception.'''
+
+def fail_on_bad(items: list[str]) -> list[str]:
+  if 'bad' in items:
+    raise ValueError('bad input')
+  if 'panic' in items:
+    raise Panic('panic')
+  return [item.upper() for item in items]
+
+def run_together(batcher: serving.MicroBatcher, requests: list[list[str]]) -> list[list[str] | BaseException]:
+  '''Runs the requests from concurrent threads, returning each one's results or error.'''
+  results: list[list[str] | BaseException] = [[] for _ in requests]
+  def run(i: int):
+    try:
+      results[i] = batcher.run(requests[i], timeout=5)
+    except BaseException as e:
+      results[i] = e
+  threads = [threading.Thread(target=run, args=(i,)) for i in range(len(requests))]
+  for thread in threads:
+    thread.start()
+  for thread in threads:
+    thread.join()
+  return results
+
+def test_bad_request_only_fails_itself():
+  # A long wait, so that the requests end up in the same batch
+  batcher = serving.MicroBatcher('test', fail_on_bad, max_wait=0.5)
+  (good, bad, other) = run_together(batcher, [['a', 'b'], ['bad'], ['c']])
+  assert good == ['A', 'B']
+  assert isinstance(bad, ValueError)
+  assert other == ['C']
+
+def test_worker_survives_a_base_exception():
+  batcher = serving.MicroBatcher('test', fail_on_bad, max_wait=0)
+  with pytest.raises(Panic):
+    batcher.run(['panic'], timeout=5)
+  assert batcher.thread.is_alive()
+  assert batcher.run(['a'], timeout=5) == ['A']
@@ -0,0 +1,70 @@
+'''
+Tests for simplify.py and simplify_exact.py, including comparing them with
+the slower versions they replace on random inputs.
+
+  python -m pytest test_simplify.py
+'''
+import random
+from simplify import group_alignments, simplify, simplify_naive
+import simplify_exact
+import simplify_slow
+
+def random_alignments(rng: random.Random, from_text: str, to_text: str, count: int) -> list[int]:
+  def span(text: str) -> list[int]:
+    start = rng.randrange(len(text))
+    return [start, rng.randint(start + 1, min(len(text), start + 4))]
+  return [x for _ in range(count) for x in [*span(from_text), *span(to_text)]]
+
+def test_greedy_same_as_naive():
+  rng = random.Random(0)
+  for _ in range(2000):
+    from_text = ''.join(rng.choice('ab  c.') for _ in range(rng.randint(1, 20)))
+    to_text = ''.join(rng.choice('xy z ') for _ in range(rng.randint(1, 20)))
+    alignments = random_alignments(rng, from_text, to_text, rng.randint(0, 30))
+    expected = simplify_naive(alignments, from_text, to_text)
+    assert simplify(alignments, from_text, to_text) == expected, (alignments, from_text, to_text)
+
+def test_exact_as_compact_as_slow():
+  rng = random.Random(0)
+  for _ in range(300):
+    from_text = ''.join(rng.choice('ab c') for _ in range(rng.randint(1, 6)))
+    to_text = ''.join(rng.choice('xy z') for _ in range(rng.randint(1, 6)))
+    alignments = []
+    for _ in range(rng.randint(0, 5)):
+      from_start = rng.randrange(len(from_text))
+      to_start = rng.randrange(len(to_text))
+      alignments += [
+        from_start, rng.randint(from_start + 1, len(from_text)),
+        to_start, rng.randint(to_start + 1, len(to_text)),
+      ]
+
+    expected = group_alignments(simplify_slow.simplify(alignments, from_text, to_text))
+    actual = group_alignments(simplify_exact.simplify(alignments, from_text, to_text, time_budget=60))
+    assert simplify_exact.cost(tuple(actual)) == simplify_exact.cost(tuple(expected)), (alignments, from_text, to_text)
+
+def test_alignment_merged_into_a_later_one_that_contains_it():
+  # (0,1,0,1) merges into (0,2,0,2). Removing merged-away alignments by value
+  # used to drop (0,2,0,2) as well, so the result was [].
+  alignments = [0, 1, 0, 1, 0, 2, 0, 2]
+  assert simplify(alignments, 'ab', 'xy') == [0, 2, 0, 2]
+  assert simplify_naive(alignments, 'ab', 'xy') == [0, 2, 0, 2]
+  assert simplify(alignments, 'ab', 'xy', 'exact') == [0, 2, 0, 2]
+
+def test_merged_alignment_equal_to_another():
+  # Merging a-x and a-y gives a-xy, which is also in the input and merged away
+  # into it. Removing by value dropped both, so the result was [].
+  alignments = [0, 1, 0, 1, 0, 1, 1, 2, 0, 1, 0, 2]
+  assert simplify(alignments, 'ab', 'xy') == [0, 1, 0, 2]
+  assert simplify_naive(alignments, 'ab', 'xy') == [0, 1, 0, 2]
+
+def test_exact_time_budget():
+  # Greedy leaves 3 alignments, where merging in another order leaves 1
+  alignments = [0, 1, 0, 2, 1, 2, 0, 2, 2, 3, 0, 2, 0, 2, 2, 3, 2, 3, 0, 3]
+  assert len(simplify(alignments, 'abcd', 'abcd', 'exact')) == 4
+  # Out of time before searching, so it's the greedy result
+  assert len(simplify(alignments, 'abcd', 'abcd', 'exact', time_budget=0)) == 12
+
+def test_exact_default_time_budget(monkeypatch):
+  alignments = [0, 1, 0, 2, 1, 2, 0, 2, 2, 3, 0, 2, 0, 2, 2, 3, 2, 3, 0, 3]
+  monkeypatch.setattr(simplify_exact, 'current_time_budget', 0)
+  assert len(simplify(alignments, 'abcd', 'abcd', 'exact')) == 12
@@ -1,45 +1,268 @@
 #!/usr/bin/env python3
 '''
 Small server to allow for running the aligner from the visualization page.
+
+Set PRELOAD_MODELS to a comma-separated list of "kind:name" models (for example
+"wsp:qiyuw/WSPAlign-ft-kftt,awesome:./models/model_without_co") to load them,
+and the tokenizers, at startup rather than on the first request, and
+MAX_MODELS to limit how many are kept in memory at once. Set MODEL_SNAPSHOTS
+to load them from memory-mapped snapshots (see snapshot.py), so that several
+server processes share one copy of the weights; /models reports the load time
+of each model and the memory unique to this process.
+
+The time spent in each stage of alignment and the latency of each request are
+exposed at /metrics in the Prometheus text format. Set METRICS=0 to turn off
+recording them.
+
+Set SERVING=batched to run inference for each model on a single worker thread
+that combines the questions from concurrent requests into shared batches (see
+serving.py), rather than on each request's own thread. Requests are rejected
+with 503 when too many are waiting, and 504 after REQUEST_TIMEOUT seconds.
+
+/align/stream takes the same parameters as /align, but responds with
+newline-delimited JSON: a line for each WSPAlign prediction above the threshold
+as soon as it's available, so that the page can start drawing before the whole
+sentence is done, followed by the final result.
+
+/align responds with the result in the binary format of binary.py rather than
+JSON when the request's Accept header prefers application/x-alignments.
 '''
-from align import align as wsp_align
-from awesome import align as awesome_align
-from flask import Flask, send_file, request
+import json
+import os
+import select
+import socket
+import sys
+import time
+from align import align_scored as wsp_align_scored, align_scored_stream as wsp_align_scored_stream, get_tokenizer, MODEL as WSP_MODEL, token_cache, TOKENIZERS
+from awesome import align as awesome_align, embedding_cache
+from cache import LRUCache, SqliteStore
+from flask import Flask, Response, send_file, request, stream_with_context
+from scored import ScoredAlignment
+from serving import Cancelled, Overloaded
+from simplify import simplify
+import binary
+import models
+import profiling
+import serving
 
 app = Flask(__name__)
 
+profiling.enabled = os.environ.get('METRICS', '1') != '0'
+
+BATCHED = os.environ.get('SERVING') == 'batched'
+
+# Results of recent /align requests, since the same text is often resubmitted
+# while only the display options change. Set RESULT_CACHE_DB to the path of a
+# SQLite database to keep them across restarts, which is limited to
+# RESULT_CACHE_DB_MB. The size of each entry includes its key, with both texts.
+result_cache = LRUCache(
+  int(os.environ.get('RESULT_CACHE_MB', 64)) * 2**20,
+  size_of=lambda result: sys.getsizeof(result) + 28 * len(result),
+  store=SqliteStore(
+    os.environ['RESULT_CACHE_DB'],
+    int(os.environ.get('RESULT_CACHE_DB_MB', 1024)) * 2**20) if os.environ.get('RESULT_CACHE_DB') else None,
+  write_through=True)
+
+# Raw WSPAlign predictions, so that changing only the threshold or symmetric
+# mode doesn't run the model again.
+scored_cache = LRUCache(
+  int(os.environ.get('SCORED_CACHE_MB', 64)) * 2**20,
+  size_of=lambda scored: scored.nbytes)
+
+def get_scored_key(from_language: str, from_text: str, to_language: str, to_text: str, quantized: bool) -> tuple:
+  return (models.get_kind('wsp', quantized), WSP_MODEL, from_language, from_text, to_language, to_text)
+
+def get_cached_scored(from_language: str, from_text: str, to_language: str, to_text: str, symmetric: bool, quantized: bool = False) -> ScoredAlignment | None:
+  # Predictions including the reverse direction can be used for either
+  key = get_scored_key(from_language, from_text, to_language, to_text, quantized)
+  scored = scored_cache.get((*key, True))
+  if scored is None and not symmetric:
+    scored = scored_cache.get((*key, False))
+  return scored
+
+def get_scored(from_language: str, from_text: str, to_language: str, to_text: str, symmetric: bool, quantized: bool = False) -> ScoredAlignment:
+  scored = get_cached_scored(from_language, from_text, to_language, to_text, symmetric, quantized)
+  if scored is None:
+    scored = wsp_align_scored(from_language, from_text, to_language, to_text, symmetric, predict=get_predict(quantized), quantized=quantized)
+    scored_cache.put((*get_scored_key(from_language, from_text, to_language, to_text, quantized), symmetric), scored)
+  return scored
+
+def get_predict(quantized: bool = False):
+  return serving.wsp_predictor(WSP_MODEL, is_cancelled=client_disconnected, quantized=quantized) if BATCHED else None
+
+def client_disconnected() -> bool:
+  '''Whether the client of the current request has closed the connection.'''
+  sock = request.environ.get('werkzeug.socket')
+  if sock is None:
+    return False
+  try:
+    readable, _, _ = select.select([sock], [], [], 0)
+    return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b''
+  except OSError:
+    return True
+
+if os.environ.get('PRELOAD_MODELS'):
+  models.preload(os.environ['PRELOAD_MODELS'].split(','))
+  for language in TOKENIZERS:
+    get_tokenizer(language)
+
 @app.get('/')
 def index():
   return send_file('visualize.html')
 
-@app.post('/align')
-def align():
-  method = request.json.get('method')
-  from_language = request.json.get('fromLanguage')
-  from_text = request.json.get('fromText')
-  to_language = request.json.get('toLanguage')
-  to_text = request.json.get('toText')
-  awesome_model = request.json.get('awesomeModel')
-  wsp_threshold = float(request.json.get('wspThreshold'))
-  wsp_symmetric = bool(request.json.get('wspSymmetric'))
-  wsp_symmetric_mode = request.json.get('wspSymmetricMode')
-
-  match method:
+@app.get('/models')
+def loaded_models():
+  return { 'models': models.stats(), 'uniqueMemory': models.get_unique_memory() }
+
+@app.get('/cache')
+def cache_stats():
+  return {
+    'results': result_cache.stats(),
+    'scored': scored_cache.stats(),
+    'tokens': token_cache.stats(),
+    'embeddings': embedding_cache.stats(),
+  }
+
+@app.get('/metrics')
+def metrics():
+  return profiling.to_prometheus(), 200, { 'Content-Type': 'text/plain; version=0.0.4' }
+
+def get_options() -> dict:
+  '''Reads the parameters of an /align request.'''
+  return {
+    'method': request.json.get('method'),
+    'from_language': request.json.get('fromLanguage'),
+    'from_text': request.json.get('fromText'),
+    'to_language': request.json.get('toLanguage'),
+    'to_text': request.json.get('toText'),
+    'awesome_model': request.json.get('awesomeModel'),
+    'wsp_threshold': float(request.json.get('wspThreshold')),
+    'wsp_symmetric': bool(request.json.get('wspSymmetric')),
+    'wsp_symmetric_mode': request.json.get('wspSymmetricMode'),
+    'simplify_mode': request.json.get('simplifyMode') or 'greedy',
+    'quantized': bool(request.json.get('quantized')),
+  }
+
+def get_result_key(o: dict) -> tuple:
+  match o['method']:
     case 'awesome':
-      result = awesome_align(from_language, from_text, to_language, to_text, awesome_model)
+      return (models.get_kind('awesome', o['quantized']), o['awesome_model'], o['from_language'], o['from_text'], o['to_language'], o['to_text'], None, None, None, o['simplify_mode'])
     case _:
-      result = wsp_align(
-        from_language,
-        from_text,
-        to_language,
-        to_text,
-        wsp_threshold,
-        wsp_symmetric,
-        wsp_symmetric_mode)
+      return (models.get_kind('wsp', o['quantized']), WSP_MODEL, o['from_language'], o['from_text'], o['to_language'], o['to_text'], o['wsp_threshold'], o['wsp_symmetric'], o['wsp_symmetric_mode'], o['simplify_mode'])
 
+def get_result(o: dict) -> list[int]:
+  key = get_result_key(o)
+  result = result_cache.get(key)
+  if result is None:
+    result = compute_result(o)
+    result_cache.put(key, result)
+  return result
+
+def compute_result(o: dict, scored: ScoredAlignment | None = None) -> list[int]:
+  '''Aligns the texts without looking in result_cache, using `scored` if the predictions are already known.'''
+  match o['method']:
+    case 'awesome':
+      extract = serving.awesome_extractor(o['awesome_model'], is_cancelled=client_disconnected, quantized=o['quantized']) if BATCHED else None
+      return awesome_align(o['from_language'], o['from_text'], o['to_language'], o['to_text'], o['awesome_model'], simplify_mode=o['simplify_mode'], extract=extract, quantized=o['quantized'])
+    case _:
+      if scored is None:
+        scored = get_scored(o['from_language'], o['from_text'], o['to_language'], o['to_text'], o['wsp_symmetric'], o['quantized'])
+      result = scored.to_ranges(o['wsp_threshold'], o['wsp_symmetric'], o['wsp_symmetric_mode'])
+      return simplify(result, o['from_text'], o['to_text'], o['simplify_mode'])
+
+@app.post('/align')
+def align():
+  start = time.perf_counter()
+  o = get_options()
+  result = get_result(o)
+  profiling.observe('request', 'awesome' if o['method'] == 'awesome' else 'wsp', time.perf_counter() - start)
+  if request.accept_mimetypes.best_match(['application/json', binary.MIME_TYPE]) == binary.MIME_TYPE:
+    return Response(binary.to_bytes([result]), mimetype=binary.MIME_TYPE)
   return {
     'result': ','.join(str(i) for i in result)
   }
 
+@app.post('/align/stream')
+def align_stream():
+  o = get_options()
+
+  def stream():
+    start = time.perf_counter()
+    try:
+      # Only WSPAlign makes a prediction per token, and only when it isn't
+      # already cached; otherwise there's just the result. Each cache is looked
+      # in once, so that its hit and miss counts are per request.
+      texts = (o['from_language'], o['from_text'], o['to_language'], o['to_text'])
+      key = get_result_key(o)
+      result = result_cache.get(key)
+      scored = None
+      if result is None and o['method'] != 'awesome':
+        scored = get_cached_scored(*texts, o['wsp_symmetric'], o['quantized'])
+      if result is None and o['method'] != 'awesome' and scored is None:
+        is_first = True
+        for prediction in wsp_align_scored_stream(*texts, o['wsp_symmetric'], predict=get_predict(o['quantized']), quantized=o['quantized']):
+          if isinstance(prediction, ScoredAlignment):
+            scored = prediction
+            scored_cache.put((*get_scored_key(*texts, o['quantized']), o['wsp_symmetric']), prediction)
+          elif prediction['score'] >= o['wsp_threshold']:
+            if is_first:
+              profiling.observe('first_prediction', 'wsp', time.perf_counter() - start)
+              is_first = False
+            yield json.dumps({
+              'type': 'prediction',
+              'direction': prediction['direction'],
+              'fromStart': prediction['from_start'],
+              'fromEnd': prediction['from_end'],
+              'toStart': prediction['to_start'],
+              'toEnd': prediction['to_end'],
+              'score': prediction['score'],
+            }) + '\n'
+
+      if result is None:
+        result = compute_result(o, scored)
+        result_cache.put(key, result)
+    except Cancelled:
+      return
+    except (Overloaded, TimeoutError) as e:
+      # The status has already been sent
+      yield json.dumps({ 'type': 'error', 'error': str(e) }) + '\n'
+      return
+    except Exception as e:
+      # Once streaming has started, Flask can no longer turn the exception into
+      # a 500, so the client only sees a truncated response unless it's told
+      app.logger.exception('Error while streaming an alignment')
+      yield json.dumps({ 'type': 'error', 'error': str(e) }) + '\n'
+      return
+
+    profiling.observe('request', 'awesome_stream' if o['method'] == 'awesome' else 'wsp_stream', time.perf_counter() - start)
+    yield json.dumps({ 'type': 'result', 'result': ','.join(str(i) for i in result) }) + '\n'
+
+  return Response(stream_with_context(stream()), mimetype='application/x-ndjson')
+
+@app.post('/align/scores')
+def align_scores():
+  '''Returns every WSPAlign prediction with its score, before thresholding.'''
+  scored = get_scored(
+    request.json.get('fromLanguage'),
+    request.json.get('fromText'),
+    request.json.get('toLanguage'),
+    request.json.get('toText'),
+    bool(request.json.get('wspSymmetric')),
+    bool(request.json.get('quantized')))
+  return scored.to_dict()
+
+@app.errorhandler(Overloaded)
+def overloaded(e: Overloaded):
+  return { 'error': str(e) }, 503, { 'Retry-After': '1' }
+
+@app.errorhandler(TimeoutError)
+def timed_out(e: TimeoutError):
+  return { 'error': str(e) }, 504
+
+@app.errorhandler(Cancelled)
+def cancelled(e: Cancelled):
+  # The client is gone, so this is never seen
+  return { 'error': 'Cancelled' }, 499
+
 if __name__ == '__main__':
   app.run()